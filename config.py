@@ -1,50 +1,21 @@
 # config.py
-VALID_DOC_TYPES = {'texto', 'markdown', 'pdf', 'docx', 'html'}
-VALID_TEMPLATES = {''} | {'carta_formal', 'contrato', 'informe', 'factura'}
-VALID_LEVELS = {'basico', 'medio', 'profesional'}
-VALID_LANGUAGES = {'es', 'en', 'fr', 'de', 'it'}
-MAX_PROMPT_LENGTH = 1500
-MAX_FIELD_LENGTH = 500
-
-TEMPLATES = {
-    "carta_formal": """
-Estimado/a {destinatario},
-
-{contenido}
-
-Atentamente,
-{remitente}
-    """,
-    "contrato": """
-CONTRATO DE {tipo}
-
-Entre {parte_a}, y {parte_b}, se acuerda lo siguiente:
-
-{contenido}
-
-Firmado en {lugar}, el {fecha}.
-
-[Firma {parte_a}]                [Firma {parte_b}]
-    """,
-    "informe": """
-INFORME: {titulo}
-
-{contenido}
-    """,
-    "factura": """
-FACTURA #{numero}
-
-Emitida a: {cliente}
-Fecha: {fecha}
-
-{contenido}
-
-Total: {total}
-    """
-}
-
-LEVEL_INSTRUCTIONS = {
-    'basico': "Genera un documento simple, breve (máximo 500 palabras), con estructura mínima (introducción, cuerpo, conclusión) y formato básico.",
-    'medio': "Genera un documento estructurado, de longitud moderada (hasta 1000 palabras), con secciones claras (antecedentes, análisis, conclusiones) y formato limpio, incluyendo listas y tablas si es relevante.",
-    'profesional': "Genera un documento extenso, altamente detallado (hasta 2000 palabras), con estructura avanzada (múltiples secciones, subsecciones, apéndices, referencias), formato profesional, tablas complejas y listas anidadas."
-}
\ No newline at end of file
+# Las constantes de validación se cargan siempre; las plantillas e instrucciones
+# por nivel (config_templates) solo se importan al acceder a ellas (PEP 562).
+from config_validation import (
+    VALID_DOC_TYPES, VALID_TEMPLATES, VALID_LEVELS, VALID_LANGUAGES,
+    is_valid_doc_type, validate_combo,
+    Level, level_from_str, MAX_PROMPT_LENGTH, MAX_FIELD_LENGTH, CHECK_PROMPT, CHECK_FIELD,
+)
+
+_LAZY_NAMES = frozenset({
+    'TEMPLATES', '_TEMPLATE_PARSED', 'REQUIRED_TEMPLATE_FIELDS', 'GENERATED_FIELD',
+    'TEMPLATE_RENDERERS', 'LEVEL_INSTRUCTIONS',
+})
+
+def __getattr__(name):
+    if name not in _LAZY_NAMES:
+        raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+    import config_templates
+    value = getattr(config_templates, name)
+    globals()[name] = value
+    return value
@@ -0,0 +1,83 @@
+# config_templates.py
+import string
+from sys import intern
+from types import MappingProxyType
+
+def _compile_renderer(pieces):
+    """Genera una función que rellena la plantilla sin pasar por str.format."""
+    parts = []
+    for literal, field in pieces:
+        if literal:
+            parts.append(repr(literal))
+        if field:
+            parts.append(f"str(values[{field!r}])")
+    namespace = {}
+    exec(f"def render(values):\n    return ''.join(({', '.join(parts)},))\n", namespace)
+    return namespace['render']
+
+TEMPLATES = MappingProxyType({intern(k): v.strip() for k, v in {
+    "carta_formal": """
+Estimado/a {destinatario},
+
+{contenido}
+
+Atentamente,
+{remitente}
+    """,
+    "contrato": """
+CONTRATO DE {tipo}
+
+Entre {parte_a}, y {parte_b}, se acuerda lo siguiente:
+
+{contenido}
+
+Firmado en {lugar}, el {fecha}.
+
+[Firma {parte_a}]                [Firma {parte_b}]
+    """,
+    "informe": """
+INFORME: {titulo}
+
+{contenido}
+    """,
+    "factura": """
+FACTURA #{numero}
+
+Emitida a: {cliente}
+Fecha: {fecha}
+
+{contenido}
+
+Total: {total}
+    """
+}.items()})
+
+def _parse_template(template: str) -> tuple:
+    """Descompone la plantilla en (texto_literal, campo); solo admite campos simples {nombre}."""
+    pieces = []
+    for literal, field, format_spec, conversion in string.Formatter().parse(template):
+        if field is not None and (not field.isidentifier() or format_spec or conversion):
+            raise ValueError(f"Campo de plantilla no soportado: {{{field}}}")
+        # Los fragmentos se internan para que los repetidos ('\n\n', 'contenido', ...) se compartan
+        pieces.append((intern(literal), intern(field) if field else field))
+    return tuple(pieces)
+
+# Plantillas ya analizadas: tupla de (texto_literal, campo) por plantilla
+_TEMPLATE_PARSED = MappingProxyType({name: _parse_template(template) for name, template in TEMPLATES.items()})
+
+# Campos que debe aportar el usuario, en orden de aparición; 'contenido' lo rellena el texto generado
+GENERATED_FIELD = 'contenido'
+REQUIRED_TEMPLATE_FIELDS = MappingProxyType({
+    name: tuple(dict.fromkeys(field for _, field in pieces if field and field != GENERATED_FIELD))
+    for name, pieces in _TEMPLATE_PARSED.items()
+})
+
+# Funciones precompiladas por plantilla: TEMPLATE_RENDERERS[nombre](valores)
+TEMPLATE_RENDERERS = MappingProxyType({name: _compile_renderer(pieces) for name, pieces in _TEMPLATE_PARSED.items()})
+
+# Tupla indexada por Level
+LEVEL_INSTRUCTIONS = (
+    "Genera un documento simple, breve (máximo 500 palabras), con estructura mínima (introducción, cuerpo, conclusión) y formato básico.",
+    "Genera un documento estructurado, de longitud moderada (hasta 1000 palabras), con secciones claras (antecedentes, análisis, conclusiones) y formato limpio, incluyendo listas y tablas si es relevante.",
+    "Genera un documento extenso, altamente detallado (hasta 2000 palabras), con estructura avanzada (múltiples secciones, subsecciones, apéndices, referencias), formato profesional, tablas complejas y listas anidadas."
+)
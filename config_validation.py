@@ -0,0 +1,43 @@
+# config_validation.py
+from enum import IntEnum
+from functools import lru_cache
+from sys import intern
+
+VALID_DOC_TYPES = frozenset(map(intern, ('texto', 'markdown', 'pdf', 'docx', 'html')))
+VALID_TEMPLATES = frozenset(map(intern, ('carta_formal', 'contrato', 'informe', 'factura')))
+VALID_LEVELS = frozenset(map(intern, ('basico', 'medio', 'profesional')))
+VALID_LANGUAGES = frozenset(map(intern, ('es', 'en', 'fr', 'de', 'it')))
+
+# Predicado ya enlazado al conjunto anterior
+is_valid_doc_type = VALID_DOC_TYPES.__contains__
+
+@lru_cache(maxsize=256)
+def validate_combo(doc_type: str, template, level: str, language: str) -> bool:
+    """Comprueba de una vez la combinación completa; las repetidas salen de la caché.
+
+    ``template`` es None cuando no se ha elegido plantilla.
+    """
+    # Con solo tres niveles basta comparar contra una tupla constante, sin calcular el hash
+    return (doc_type in VALID_DOC_TYPES and (template is None or template in VALID_TEMPLATES)
+            and level in ('basico', 'medio', 'profesional') and language in VALID_LANGUAGES)
+
+class Level(IntEnum):
+    BASICO = 0
+    MEDIO = 1
+    PROFESIONAL = 2
+
+# Traduce el nivel recibido por la API a su índice en LEVEL_INSTRUCTIONS
+level_from_str = {'basico': Level.BASICO, 'medio': Level.MEDIO, 'profesional': Level.PROFESIONAL}.__getitem__
+
+MAX_PROMPT_LENGTH = 1500
+MAX_FIELD_LENGTH = 500
+
+def _make_len_check(limit: int, message: str):
+    """Crea un validador de longitud con el límite y el mensaje ya resueltos."""
+    def check(value: str, name: str = '', _limit=limit, _len=len) -> None:
+        if _len(value) > _limit:
+            raise ValueError(message.format(name=name, limit=_limit))
+    return check
+
+CHECK_PROMPT = _make_len_check(MAX_PROMPT_LENGTH, 'El prompt excede el límite de {limit} caracteres.')
+CHECK_FIELD = _make_len_check(MAX_FIELD_LENGTH, 'El campo {name} excede el límite de {limit} caracteres.')
@@ -1,253 +1,578 @@
 import io
+import json
 import uuid
 import re
-import markdown
+import asyncio
+import atexit
+import random
+import threading
+from html import escape
+from hashlib import blake2b
+from typing import IO
+from functools import lru_cache
 import logging
-from openai import OpenAI, AuthenticationError, RateLimitError, APIConnectionError
-from cachetools import TTLCache
-from utils import generate_cache_key, sanitize_fields, parse_markdown_for_pdf, summarize_history
-from config import TEMPLATES, LEVEL_INSTRUCTIONS
-from reportlab.lib.pagesizes import letter
-from reportlab.platypus import SimpleDocTemplate
-from reportlab.lib.styles import getSampleStyleSheet
-from reportlab.lib.units import inch as reportlab_inch
-from docx import Document
-from docx.shared import Pt, Inches
-from docx.enum.style import WD_STYLE_TYPE
-from docx.enum.text import WD_ALIGN_PARAGRAPH
-from docx.oxml.ns import qn
-from docx.shared import RGBColor
+import httpx
+from cachetools import TTLCache, cached
+from jinja2 import Environment
+from openai import AsyncOpenAI, AuthenticationError, RateLimitError, APIConnectionError
+from response_cache import ResponseCache
+from rate_limiter import RateLimiter
+from utils import (configure_logging, generate_cache_key, sanitize_fields, parse_markdown_for_pdf, summarize_history,
+                   logo_ok, parse_chart_line, generate_chart)
+from config import TEMPLATES, LEVEL_INSTRUCTIONS, level_from_str
 import os
+# reportlab, python-docx y markdown se importan dentro de las ramas de render que los usan
 
 # Configuramos el logging
-logging.basicConfig(level=logging.INFO, filename='app.log', format='%(asctime)s - %(levelname)s - %(message)s')
+configure_logging()
+
+# Saludos y frases cortas que no requieren un documento formal
+_CONV_RE = re.compile(r'^\s*(?:hola|cómo estás\s*\??|hey|hi|qué tal\s*\??|hello)\s*$', re.IGNORECASE)
+
+# Clasifica cada línea Markdown (ya sin espacios) con una sola búsqueda
+_MD_LINE = re.compile(r'(?P<h3>### )|(?P<h2>## )|(?P<h1># )|(?P<li>[-*] )|(?P<tbl>\|)')
+
+# Campos dinámicos en formato {campo} dentro de una plantilla
+_FIELD_RE = re.compile(r'\{(\w+)\}')
+COMMON_FIELDS = ('nombre', 'fecha', 'direccion', 'empresa')
+
+# Sugerencias de prompts por plantilla (ya limitadas a 3) y prompts populares generales
+PROMPT_SUGGESTIONS = {
+    'carta_formal': (
+        "Redacta una carta formal invitando a un evento corporativo",
+        "Escribe una carta de presentación para una solicitud de empleo",
+        "Genera una carta formal de agradecimiento por una colaboración"
+    ),
+    'informe': (
+        "Crea un informe sobre el impacto de la inteligencia artificial en la industria",
+        "Redacta un informe técnico sobre energías renovables",
+        "Genera un informe de progreso para un proyecto de desarrollo"
+    ),
+    'contrato': (
+        "Escribe un contrato de prestación de servicios entre dos partes",
+        "Redacta un contrato de arrendamiento para una propiedad",
+        "Genera un contrato de confidencialidad para empleados"
+    ),
+    'factura': (
+        "Crea una factura para servicios de consultoría",
+        "Redacta una factura para la venta de productos",
+        "Genera una factura con detalles de impuestos incluidos"
+    )
+}
+POPULAR_PROMPTS = (
+    "Redacta una carta formal invitando a un evento",
+    "Escribe un informe sobre inteligencia artificial",
+    "Crea un contrato de servicios profesionales"
+)
+
+# Campos sugeridos por contenido de plantilla; la clave es un resumen blake2b para no
+# guardar ni volver a hashear textos largos
+@cached(cache=TTLCache(maxsize=256, ttl=600),
+        key=lambda template_content: blake2b(template_content.encode('utf-8'), digest_size=16).digest(),
+        lock=threading.Lock())
+def _suggest_fields(template_content: str) -> tuple:
+    # Buscar campos en formato {campo}, sin duplicados y en orden de aparición
+    suggested = dict.fromkeys(_FIELD_RE.findall(template_content))
+    # Añadir campos comunes si no están presentes
+    for field in COMMON_FIELDS:
+        suggested.setdefault(field)
+    return tuple(suggested)[:5]  # Limitar a 5 sugerencias
+
+MAX_TOKENS = {'basico': 1000, 'medio': 2000, 'profesional': 4000}
+MAX_WORDS = {'basico': 500, 'medio': 1000, 'profesional': 2000}
+_HEADING_PREFIXES = ('# ', '## ', '### ')
+
+# Reintentos con espera exponencial cuando la API devuelve 429
+MAX_RATE_LIMIT_RETRIES = 3
+
+# Solo se guarda el inicio del último documento; el contexto usa apenas los primeros 200 caracteres
+LAST_DOCUMENT_CHARS = 2000
+
+STRICT_RETRY_SUFFIX = "\nPor favor, asegúrate de incluir al menos un encabezado (#, ##) en el contenido y seguir la estructura solicitada según el nivel."
+
+# Estilos de python-docx (en minúsculas) que la vista previa trata de forma especial
+_PREVIEW_KINDS = {
+    'heading 1': 'h1', 'heading 2': 'h2', 'heading 3': 'h3',
+    'list bullet': 'li', 'list bullet 2': 'li', 'list bullet 3': 'li',
+    'list number': 'li', 'list number 2': 'li', 'list number 3': 'li',
+}
+_HALF_INCH_EMU = 457200
+
+# Color corporativo (#4f46e5) para los encabezados DOCX, como tupla para no importar python-docx al cargar el módulo
+_BRAND = (79, 70, 229)
+
+# (nombre, tamaño, negrita, color, space_after, space_before, line_spacing, justificado, sangría en pulgadas)
+_STYLE_SPECS = (
+    ('CustomHeading1', 16, True, _BRAND, 12, 18, None, False, None),   # secciones numeradas
+    ('CustomHeading2', 14, True, _BRAND, 10, 12, None, False, None),   # subsecciones numeradas
+    ('CustomHeading3', 12, True, _BRAND, 8, 8, None, False, None),
+    ('CustomNormal', 11, None, None, 6, None, 1.15, True, None),       # párrafos
+    ('CustomList', 11, None, None, 6, None, 1.15, True, 0.5),          # listas
+)
+
+def _ensure_styles(doc) -> None:
+    """Crea en el documento los estilos personalizados que aún no existan."""
+    from docx.shared import Pt, Inches, RGBColor
+    from docx.enum.style import WD_STYLE_TYPE
+    from docx.enum.text import WD_ALIGN_PARAGRAPH
+    styles = doc.styles
+    for name, size, bold, color, space_after, space_before, line_spacing, justify, indent in _STYLE_SPECS:
+        if name in styles:
+            continue
+        style = styles.add_style(name, WD_STYLE_TYPE.PARAGRAPH)
+        font = style.font
+        font.name = 'Calibri'
+        font.size = Pt(size)
+        if bold:
+            font.bold = True
+        if color is not None:
+            font.color.rgb = RGBColor(*color)
+        fmt = style.paragraph_format
+        if line_spacing is not None:
+            fmt.line_spacing = line_spacing
+        fmt.space_after = Pt(space_after)
+        if space_before is not None:
+            fmt.space_before = Pt(space_before)
+        if justify:
+            fmt.alignment = WD_ALIGN_PARAGRAPH.JUSTIFY
+        if indent is not None:
+            fmt.left_indent = Inches(indent)
+
+# 1 twip = 635 EMU; la sangría de cada nivel de lista es media pulgada (720 twips)
+_EMU_PER_TWIP = 635
+_LIST_INDENT_TWIPS = 720
+
+def _paragraph_xml(text: str, style: str, indent_twips: int = None) -> str:
+    """Devuelve el XML de un párrafo <w:p> con el estilo indicado."""
+    indent = f'<w:ind w:left="{indent_twips}"/>' if indent_twips else ''
+    return (f'<w:p><w:pPr><w:pStyle w:val="{style}"/>{indent}</w:pPr>'
+            f'<w:r><w:t xml:space="preserve">{escape(text, quote=False)}</w:t></w:r></w:p>')
+
+def _table_xml(table_data: list, width_twips: int) -> str:
+    """Devuelve el XML de una tabla <w:tbl> con encabezado en color corporativo,
+    seguida del párrafo de separación."""
+    cols = len(table_data[0])
+    col_width = width_twips // cols
+    parts = ['<w:tbl><w:tblPr><w:tblStyle w:val="TableGrid"/><w:tblW w:type="auto" w:w="0"/>'
+             '<w:tblLook w:firstRow="1" w:lastRow="0" w:firstColumn="1" w:lastColumn="0" w:noHBand="0" w:noVBand="1" w:val="04A0"/>'
+             '</w:tblPr><w:tblGrid>']
+    parts.append(f'<w:gridCol w:w="{col_width}"/>' * cols)
+    parts.append('</w:tblGrid>')
+    # La primera fila es el encabezado: fondo #4f46e5 y texto blanco en negrita
+    cell_pr = f'<w:tcPr><w:tcW w:type="dxa" w:w="{col_width}"/></w:tcPr>'
+    header_pr = f'<w:tcPr><w:tcW w:type="dxa" w:w="{col_width}"/><w:shd w:val="clear" w:color="auto" w:fill="4f46e5"/></w:tcPr>'
+    for i, row_data in enumerate(table_data):
+        tc_pr, run_pr = (header_pr, '<w:rPr><w:b/><w:color w:val="FFFFFF"/></w:rPr>') if i == 0 else (cell_pr, '')
+        parts.append('<w:tr>')
+        # Las filas se ajustan al número de columnas del encabezado
+        for j in range(cols):
+            cell_text = row_data[j] if j < len(row_data) else ''
+            run = f'<w:r>{run_pr}<w:t xml:space="preserve">{escape(cell_text, quote=False)}</w:t></w:r>' if cell_text else ''
+            parts.append(f'<w:tc>{tc_pr}<w:p><w:pPr><w:pStyle w:val="CustomNormal"/></w:pPr>{run}</w:p></w:tc>')
+        parts.append('</w:tr>')
+    # Ajustar el espaciado después de la tabla (12 pt)
+    parts.append('</w:tbl><w:p><w:pPr><w:spacing w:before="240"/></w:pPr></w:p>')
+    return ''.join(parts)
+
+# Markdown ya convertido a HTML, por contenido; /preview se repite a menudo con el mismo texto
+@cached(cache=TTLCache(maxsize=512, ttl=1800),
+        key=lambda text, nl2br=False: (blake2b(text.encode('utf-8'), digest_size=16).hexdigest(), nl2br),
+        lock=threading.Lock())
+def _render_md(text: str, nl2br: bool = False) -> str:
+    """Convierte Markdown a HTML con las extensiones de tablas y bloques de código."""
+    if nl2br:
+        # markdown-it no tiene equivalente a nl2br; la salida Markdown sigue con Python-Markdown
+        import markdown
+        return markdown.markdown(text, extensions=['tables', 'fenced_code', 'nl2br'])
+    return _markdown_parser().render(text)
+
+@lru_cache(maxsize=None)
+def _markdown_parser():
+    """Parser CommonMark (markdown-it en Rust) con tablas; se crea una vez y se reutiliza."""
+    from markdown_it_pyrs import MarkdownIt
+    return MarkdownIt('commonmark').enable('table')
+
+# Fuente de la plantilla del documento HTML; solo cambian el título, el idioma y el cuerpo
+_HTML_TEMPLATE_SRC = """
+<!DOCTYPE html>
+<html lang="{{ language }}">
+<head>
+    <meta charset="UTF-8">
+    <title>{{ file_name }}</title>
+    <style>
+        body { 
+            font-family: 'Calibri', sans-serif; 
+            margin: 40px auto; 
+            line-height: 1.6; 
+            max-width: 900px; 
+            padding: 0 20px; 
+            color: #333; 
+            background-color: #f9f9f9; 
+        }
+        h1 { 
+            color: #4f46e5; 
+            font-size: 32px; 
+            border-bottom: 3px solid #4f46e5; 
+            padding-bottom: 8px; 
+            margin-bottom: 25px; 
+            text-align: center; 
+        }
+        h2 { 
+            color: #4f46e5; 
+            font-size: 24px; 
+            margin-top: 30px; 
+            margin-bottom: 15px; 
+            border-left: 5px solid #4f46e5; 
+            padding-left: 10px; 
+        }
+        h3 { 
+            color: #4f46e5; 
+            font-size: 20px; 
+            margin-top: 20px; 
+            margin-bottom: 10px; 
+        }
+        ul, ol { 
+            margin: 15px 0; 
+            padding-left: 30px; 
+        }
+        li { 
+            margin-bottom: 10px; 
+        }
+        table { 
+            border-collapse: collapse; 
+            width: 100%; 
+            margin: 20px 0; 
+            box-shadow: 0 3px 8px rgba(0,0,0,0.1); 
+            background-color: #fff; 
+        }
+        th, td { 
+            border: 1px solid #ddd; 
+            padding: 12px; 
+            text-align: left; 
+        }
+        th { 
+            background-color: #f0f0f0; 
+            font-weight: bold; 
+            color: #333; 
+        }
+        p { 
+            margin: 12px 0; 
+            text-align: justify; 
+            font-size: 16px; 
+        }
+        .info-box, .config-box { 
+            background-color: #fff; 
+            border: 2px solid #4f46e5; 
+            border-radius: 8px; 
+            padding: 20px; 
+            margin: 20px 0; 
+            box-shadow: 0 3px 8px rgba(0,0,0,0.1); 
+        }
+        .info-box h2, .config-box h2 { 
+            margin-top: 0; 
+            border-left: none; 
+            padding-left: 0; 
+        }
+        .config-box table { 
+            box-shadow: none; 
+            margin: 0; 
+        }
+        hr { 
+            border: 0; 
+            border-top: 1px solid #ddd; 
+            margin: 20px 0; 
+        }
+    </style>
+</head>
+<body>
+    <h1>{{ file_name }}</h1>
+    <div class="info-box">
+        <h2>Información sobre la IA</h2>
+        <p>
+            Este documento fue generado por <strong>GarbotGPT</strong>, una IA desarrollada por GarolaCorp. GarBotGPT está diseñado para asistir a los usuarios en la creación de documentos profesionales y bien estructurados, ofreciendo respuestas útiles y precisas. Este documento se generó utilizando un modelo avanzado de IA con parámetros optimizados para claridad y profesionalismo.
+        </p>
+        <p>
+            <strong>Fecha de Generación:</strong> 05 de Mayo de 2025<br>
+            <strong>Idioma:</strong> {{ language|upper }}<br>
+            <strong>Plataforma:</strong> GarBotGPT Generador de documentos
+        </p>
+    </div>
+    <div class="config-box">
+        <h2>Configuración del Documento</h2>
+        <p>A continuación, se detalla la configuración utilizada para generar este documento:</p>
+        <table>
+            <tr>
+                <th>Parámetro</th>
+                <th>Valor</th>
+            </tr>
+            <tr>
+                <td>Fuente Principal</td>
+                <td>Calibri</td>
+            </tr>
+            <tr>
+                <td>Tamaño de Fuente</td>
+                <td>16px (Encabezados), 11px (Cuerpo)</td>
+            </tr>
+            <tr>
+                <td>Color Principal</td>
+                <td>#4f46e5</td>
+            </tr>
+            <tr>
+                <td>Márgenes</td>
+                <td>1 pulgada (todos los lados)</td>
+            </tr>
+            <tr>
+                <td>Tema</td>
+                <td>Moderno (Claro)</td>
+            </tr>
+            <tr>
+                <td>Espaciado de Líneas</td>
+                <td>1.15</td>
+            </tr>
+        </table>
+    </div>
+    <hr>
+    {{ body|safe }}
+</body>
+</html>
+"""
+
+# Compilada una vez; autoescape protege título e idioma, el cuerpo ya es HTML generado
+_HTML_TEMPLATE = Environment(autoescape=True).from_string(_HTML_TEMPLATE_SRC)
+
+@lru_cache(maxsize=32)
+def _base_system_message(level: str, language: str) -> str:
+    """Parte fija del mensaje de sistema para documentos; solo depende del nivel y el idioma."""
+    # Estructura base para todos los niveles
+    system_message = (
+        "Eres un asistente de IA especializado en la redacción de documentos profesionales, precisos y bien estructurados. "
+        "Tu objetivo es generar contenido que sea claro, conciso y adaptado al propósito del documento. "
+        f"Genera el contenido en {language}. "
+        f"{LEVEL_INSTRUCTIONS[level_from_str(level)]} "
+        "Sigue estas reglas para estructurar el documento:\n"
+        "- **Organización Clara y Lógica**: Organiza el contenido en secciones bien diferenciadas con subtítulos claros (#, ##, etc.). "
+        "Asegúrate de que cada sección siga un flujo coherente con transiciones suaves.\n"
+        "- **Introducción Ampliada**: Comienza con una **Introducción** que dé una visión general del tema, explique su contexto y su relevancia, preparando al lector para los puntos principales.\n"
+        "- **Contenido Detallado y Ejemplos Prácticos**: En las secciones principales, proporciona información detallada e incluye ejemplos prácticos, casos de uso o datos ficticios realistas.\n"
+        "- **Conclusión Clara y Concisa**: Termina con una **Conclusión** que resuma los puntos clave y, si corresponde, proponga futuras líneas de investigación o acción.\n"
+        "- Usa un tono formal y profesional, evitando repeticiones innecesarias.\n"
+        "- Usa listas con viñetas ('-') para enumerar elementos cuando sea necesario.\n"
+        "- Evita jerga innecesaria y asegúrate de que el lenguaje sea accesible para un público profesional.\n"
+    )
+
+    # Estructura específica según el nivel
+    if level == 'basico':
+        system_message += (
+            "\n**Estructura para Nivel Básico**:\n"
+            "Organiza el documento en las siguientes secciones:\n"
+            "- **# Introducción**: Proporciona una visión general del tema, su contexto y relevancia (mínimo 3-4 oraciones detalladas).\n"
+            "- **## Descripción**: Describe el tema en detalle, explicando qué es y cómo funciona (mínimo 2 párrafos).\n"
+            "- **## Conclusión**: Resume los puntos clave y menciona la importancia del tema (mínimo 2-3 oraciones).\n"
+            "Incluye al menos un ejemplo práctico simple en la sección de Descripción."
+        )
+    elif level == 'medio':
+        system_message += (
+            "\n**Estructura para Nivel Medio**:\n"
+            "Organiza el documento en las siguientes secciones:\n"
+            "- **# Introducción**: Proporciona una visión general del tema, su contexto y relevancia.\n"
+            "- **## Descripción**: Describe el tema en detalle, explicando qué es y cómo funciona.\n"
+            "- **## Historia o Evolución**: Explica el origen o la evolución del tema a lo largo del tiempo.\n"
+            "- **## Aplicaciones y Usos Prácticos**: Detalla cómo se aplica el tema en la vida real, con ejemplos concretos.\n"
+            "- **## Conclusión**: Resume los puntos clave y propone posibles direcciones futuras.\n"
+            "Incluye ejemplos prácticos en la sección de Aplicaciones y Usos Prácticos."
+        )
+    elif level == 'profesional':
+        system_message += (
+            "\n**Estructura para Nivel Profesional**:\n"
+            "Organiza el documento en las siguientes secciones:\n"
+            "- **# Introducción**: Proporciona una visión general del tema, su contexto y relevancia.\n"
+            "- **## Descripción**: Describe el tema en detalle, explicando qué es y cómo funciona.\n"
+            "- **## Historia o Evolución**: Explica el origen o la evolución del tema a lo largo del tiempo.\n"
+            "- **## Características Principales**: Detalla las características clave del tema.\n"
+            "- **## Aplicaciones y Usos Prácticos**: Describe aplicaciones reales, con ejemplos concretos.\n"
+            "- **## Beneficios**: Explica los beneficios del tema para los usuarios o la industria.\n"
+            "- **## Limitaciones**: Analiza las limitaciones o desafíos asociados con el tema.\n"
+            "- **## Consideraciones Éticas**: Aborda posibles riesgos éticos, como sesgos o problemas de privacidad (si aplica).\n"
+            "- **## Comparación con Alternativas**: Compara el tema con otras soluciones o tecnologías similares.\n"
+            "- **## Estudios de Caso**: Incluye un estudio de caso o ejemplo detallado de implementación.\n"
+            "- **## Impacto Futuro**: Discute cómo el tema podría evolucionar en el futuro.\n"
+            "- **## Recomendaciones**: Propón recomendaciones para su uso, implementación o mejora.\n"
+            "- **## Conclusión**: Resume los puntos clave y destaca la importancia del tema.\n"
+            "Asegúrate de incluir ejemplos prácticos, datos ficticios realistas, y análisis profundos en las secciones correspondientes."
+        )
+
+    if level in ['medio', 'profesional']:
+        system_message += (
+            "\n- **Importante**: Para niveles medio y profesional, el documento debe incluir al menos un encabezado (por ejemplo, # Título, ## Subtítulo) "
+            "para estructurar el contenido de manera clara."
+        )
+    return system_message
 
 class DocumentGenerator:
-    def __init__(self, api_key: str):
-        self.client = OpenAI(api_key=api_key)
-        self.cache = TTLCache(maxsize=100, ttl=3600)
-        self.conversation_context = {}  # Almacena el contexto por session_id
+    def __init__(self, api_key: str, max_requests_per_minute: int = 500, max_tokens_per_minute: int = 30000):
+        # Bucle de eventos propio en un hilo aparte: todas las peticiones a OpenAI se
+        # multiplexan en él y comparten el mismo pool de conexiones
+        self.loop = asyncio.new_event_loop()
+        threading.Thread(target=self.loop.run_forever, name='openai-loop', daemon=True).start()
+        # HTTP/2 multiplexa las peticiones concurrentes sobre pocas conexiones TLS
+        self.aclient = AsyncOpenAI(
+            api_key=api_key,
+            http_client=httpx.AsyncClient(
+                http2=True,
+                limits=httpx.Limits(max_connections=200, max_keepalive_connections=50),
+                timeout=httpx.Timeout(60.0, connect=5.0)
+            )
+        )
+        atexit.register(self.close)
+        self.rate_limiter = RateLimiter(max_requests_per_minute, max_tokens_per_minute)
+        self.cache = ResponseCache(redis_url=os.getenv("REDIS_URL"))
+        # Contexto por session_id; las sesiones inactivas durante un día se descartan
+        self.conversation_context = TTLCache(maxsize=10000, ttl=24 * 3600)
+        # TTLCache no es seguro entre hilos (incluso get() expira y reordena entradas): lo usan
+        # el hilo del bucle de OpenAI y los hilos de las peticiones (reset_context)
+        self._context_lock = threading.Lock()
+
+    def close(self):
+        """Cierra el cliente de OpenAI y sus conexiones; se ejecuta al salir del proceso."""
+        if self.loop.is_running():
+            try:
+                self.run_sync(self.aclient.close())
+            except Exception as e:
+                logging.error(f"Error al cerrar el cliente de OpenAI: {str(e)}")
 
     def is_conversational_prompt(self, prompt: str) -> bool:
         """Determina si el prompt es conversacional y no requiere un documento formal."""
-        conversational_keywords = [
-            r'^\s*hola\s*$', r'^\s*cómo estás\s*\??\s*$', r'^\s*hey\s*$', r'^\s*hi\s*$',
-            r'^\s*qué tal\s*\??\s*$', r'^\s*hello\s*$'
-        ]
-        prompt = prompt.lower().strip()
-        return any(re.match(pattern, prompt, re.IGNORECASE) for pattern in conversational_keywords)
+        return _CONV_RE.match(prompt) is not None
+
+    def run_sync(self, coro):
+        """Ejecuta una corrutina en el bucle del generador y espera su resultado."""
+        return asyncio.run_coroutine_threadsafe(coro, self.loop).result()
+
+    async def run_async(self, coro):
+        """Como run_sync, pero se espera desde otro bucle (vistas async de Flask) sin bloquearlo."""
+        return await asyncio.wrap_future(asyncio.run_coroutine_threadsafe(coro, self.loop))
 
     def reset_context(self, session_id: str):
         """Reinicia el contexto de la conversación para una sesión específica."""
-        if session_id in self.conversation_context:
-            del self.conversation_context[session_id]
+        with self._context_lock:
+            self.conversation_context.pop(session_id, None)
         logging.info(f"Contexto reiniciado para session_id: {session_id}")
 
     def get_prompt_suggestions(self, doc_type: str, template: str) -> list:
         """Devuelve sugerencias de prompts basadas en el tipo de documento y la plantilla."""
-        suggestions = {
-            'carta_formal': [
-                "Redacta una carta formal invitando a un evento corporativo",
-                "Escribe una carta de presentación para una solicitud de empleo",
-                "Genera una carta formal de agradecimiento por una colaboración"
-            ],
-            'informe': [
-                "Crea un informe sobre el impacto de la inteligencia artificial en la industria",
-                "Redacta un informe técnico sobre energías renovables",
-                "Genera un informe de progreso para un proyecto de desarrollo"
-            ],
-            'contrato': [
-                "Escribe un contrato de prestación de servicios entre dos partes",
-                "Redacta un contrato de arrendamiento para una propiedad",
-                "Genera un contrato de confidencialidad para empleados"
-            ],
-            'factura': [
-                "Crea una factura para servicios de consultoría",
-                "Redacta una factura para la venta de productos",
-                "Genera una factura con detalles de impuestos incluidos"
-            ]
-        }
-        # Prompts populares generales
-        popular_prompts = [
-            "Redacta una carta formal invitando a un evento",
-            "Escribe un informe sobre inteligencia artificial",
-            "Crea un contrato de servicios profesionales",
-            "Genera una factura para una venta"
-        ]
-        return suggestions.get(template, popular_prompts)[:3]
+        return list(PROMPT_SUGGESTIONS.get(template, POPULAR_PROMPTS))
 
     def suggest_fields(self, template_content: str) -> list:
         """Sugiere campos dinámicos basados en el contenido de la plantilla."""
-        # Buscar campos en formato {campo}
-        fields = re.findall(r'\{(\w+)\}', template_content)
-        # Añadir campos comunes si no están presentes
-        common_fields = ['nombre', 'fecha', 'direccion', 'empresa']
-        suggested_fields = list(set(fields + [f for f in common_fields if f not in fields]))
-        return suggested_fields[:5]  # Limitar a 5 sugerencias
+        return list(_suggest_fields(template_content))
 
     def validate_generated_text(self, text: str, level: str, is_conversational: bool) -> tuple[bool, str]:
         word_count = len(text.split())
-        max_words = {'basico': 500, 'medio': 1000, 'profesional': 2000}
-        
-        if word_count > max_words[level]:
-            return False, f"El contenido excede el límite de palabras para el nivel {level} ({max_words[level]} palabras). Tiene {word_count} palabras."
+        max_words = MAX_WORDS[level]
+
+        if word_count > max_words:
+            return False, f"El contenido excede el límite de palabras para el nivel {level} ({max_words} palabras). Tiene {word_count} palabras."
         
         if word_count < 50 and not is_conversational:
             return False, "El contenido es demasiado corto (menos de 50 palabras)."
         
         if level in ['medio', 'profesional'] and not is_conversational:
-            if not re.search(r'^.*\n*(# .+|## .+|### .+)', text, re.MULTILINE):
+            # Recorrido lineal con salida temprana en el primer encabezado
+            if not any(line.lstrip().startswith(_HEADING_PREFIXES) for line in text.splitlines()):
                 return False, "El documento debe tener al menos un encabezado para niveles medio o profesional."
         
         return True, "Contenido válido."
 
-    def generate(self, prompt: str, doc_type: str, template: str, fields: dict, level: str, language: str, history: list, session_id: str) -> tuple[str, bool]:
-        is_conversational = self.is_conversational_prompt(prompt)
+    def iter_sync(self, agen):
+        """Recorre un generador asíncrono del bucle del generador desde código síncrono."""
+        try:
+            while True:
+                try:
+                    yield self.run_sync(agen.__anext__())
+                except StopAsyncIteration:
+                    return
+        finally:
+            # Si el cliente corta el stream se cierra también la petición a OpenAI
+            self.run_sync(agen.aclose())
+
+    def _build_messages(self, prompt: str, template: str, level: str, language: str, history: list, session_id: str, is_conversational: bool) -> list:
         history_summary = summarize_history(history) if not is_conversational else ""
         
-        # Inicializar contexto para la sesión si no existe
-        if session_id not in self.conversation_context:
-            self.conversation_context[session_id] = {
-                'last_document': None,
-                'last_prompt': None,
-                'last_doc_type': None,
-                'last_template': None,
-                'last_level': None,
-                'last_language': None
-            }
-
-        # Añadir contexto previo al system_message si existe
-        context_summary = ""
-        if self.conversation_context[session_id]['last_document'] and not is_conversational:
-            context_summary = (
-                f"\nContexto del documento anterior:\n"
-                f"- Tipo de documento: {self.conversation_context[session_id]['last_doc_type']}\n"
-                f"- Plantilla: {self.conversation_context[session_id]['last_template']}\n"
-                f"- Nivel: {self.conversation_context[session_id]['last_level']}\n"
-                f"- Idioma: {self.conversation_context[session_id]['last_language']}\n"
-                f"- Contenido previo (resumen): {self.conversation_context[session_id]['last_document'][:200]}...\n"
-                "Si el usuario solicita modificaciones (por ejemplo, 'añade una cláusula'), aplica los cambios al documento anterior manteniendo su estructura y estilo."
-            )
+        # Añadir contexto previo al system_message si existe (el bloque se formatea al guardar el contexto)
+        with self._context_lock:
+            ctx = self.conversation_context.get(session_id)
+        context_summary = ctx['context_summary'] if ctx and ctx['last_document'] and not is_conversational else ""
 
         if is_conversational:
-            system_message = (
+            system_messages = [{"role": "system", "content": (
                 "Eres Grok, una IA desarrollada por xAI. Responde de manera breve, amigable y directa en el idioma especificado. "
                 f"Idioma: {language}. "
                 "Evita generar documentos estructurados o encabezados a menos que se solicite explícitamente."
-            )
+            )}]
         else:
-            # Estructura base para todos los niveles
-            system_message = (
-                "Eres un asistente de IA especializado en la redacción de documentos profesionales, precisos y bien estructurados. "
-                "Tu objetivo es generar contenido que sea claro, conciso y adaptado al propósito del documento. "
-                f"Genera el contenido en {language}. "
-                f"{LEVEL_INSTRUCTIONS[level]} "
-                "Sigue estas reglas para estructurar el documento:\n"
-                "- **Organización Clara y Lógica**: Organiza el contenido en secciones bien diferenciadas con subtítulos claros (#, ##, etc.). "
-                "Asegúrate de que cada sección siga un flujo coherente con transiciones suaves.\n"
-                "- **Introducción Ampliada**: Comienza con una **Introducción** que dé una visión general del tema, explique su contexto y su relevancia, preparando al lector para los puntos principales.\n"
-                "- **Contenido Detallado y Ejemplos Prácticos**: En las secciones principales, proporciona información detallada e incluye ejemplos prácticos, casos de uso o datos ficticios realistas.\n"
-                "- **Conclusión Clara y Concisa**: Termina con una **Conclusión** que resuma los puntos clave y, si corresponde, proponga futuras líneas de investigación o acción.\n"
-                "- Usa un tono formal y profesional, evitando repeticiones innecesarias.\n"
-                "- Usa listas con viñetas ('-') para enumerar elementos cuando sea necesario.\n"
-                "- Evita jerga innecesaria y asegúrate de que el lenguaje sea accesible para un público profesional.\n"
-                f"{history_summary}\n{context_summary}"
+            # La parte fija va sola y primero para que el prefijo sea idéntico entre llamadas
+            # y OpenAI pueda reutilizarlo (prompt caching); lo que cambia va en un segundo mensaje
+            volatile_message = f"{history_summary}\n{context_summary}".strip()
+            if template in TEMPLATES:
+                volatile_message += f" Usa esta plantilla como base:\n{TEMPLATES[template]}"
+            system_messages = [{"role": "system", "content": _base_system_message(level, language)}]
+            if volatile_message:
+                system_messages.append({"role": "system", "content": volatile_message})
+
+        return system_messages + history + [{"role": "user", "content": prompt}]
+
+    def _remember_document(self, session_id: str, generated_text: str, prompt: str, doc_type: str, template: str, level: str, language: str):
+        context = {
+            'last_document': generated_text[:LAST_DOCUMENT_CHARS],
+            'last_prompt': prompt,
+            'last_doc_type': doc_type,
+            'last_template': template,
+            'last_level': level,
+            'last_language': language,
+            'context_summary': (
+                f"\nContexto del documento anterior:\n"
+                f"- Tipo de documento: {doc_type}\n"
+                f"- Plantilla: {template}\n"
+                f"- Nivel: {level}\n"
+                f"- Idioma: {language}\n"
+                f"- Contenido previo (resumen): {generated_text[:200]}...\n"
+                "Si el usuario solicita modificaciones (por ejemplo, 'añade una cláusula'), aplica los cambios al documento anterior manteniendo su estructura y estilo."
             )
+        }
+        # Se reasigna la entrada para renovar su TTL
+        with self._context_lock:
+            self.conversation_context[session_id] = context
 
-            # Estructura específica según el nivel
-            if level == 'basico':
-                system_message += (
-                    "\n**Estructura para Nivel Básico**:\n"
-                    "Organiza el documento en las siguientes secciones:\n"
-                    "- **# Introducción**: Proporciona una visión general del tema, su contexto y relevancia (mínimo 3-4 oraciones detalladas).\n"
-                    "- **## Descripción**: Describe el tema en detalle, explicando qué es y cómo funciona (mínimo 2 párrafos).\n"
-                    "- **## Conclusión**: Resume los puntos clave y menciona la importancia del tema (mínimo 2-3 oraciones).\n"
-                    "Incluye al menos un ejemplo práctico simple en la sección de Descripción."
-                )
-            elif level == 'medio':
-                system_message += (
-                    "\n**Estructura para Nivel Medio**:\n"
-                    "Organiza el documento en las siguientes secciones:\n"
-                    "- **# Introducción**: Proporciona una visión general del tema, su contexto y relevancia.\n"
-                    "- **## Descripción**: Describe el tema en detalle, explicando qué es y cómo funciona.\n"
-                    "- **## Historia o Evolución**: Explica el origen o la evolución del tema a lo largo del tiempo.\n"
-                    "- **## Aplicaciones y Usos Prácticos**: Detalla cómo se aplica el tema en la vida real, con ejemplos concretos.\n"
-                    "- **## Conclusión**: Resume los puntos clave y propone posibles direcciones futuras.\n"
-                    "Incluye ejemplos prácticos en la sección de Aplicaciones y Usos Prácticos."
-                )
-            elif level == 'profesional':
-                system_message += (
-                    "\n**Estructura para Nivel Profesional**:\n"
-                    "Organiza el documento en las siguientes secciones:\n"
-                    "- **# Introducción**: Proporciona una visión general del tema, su contexto y relevancia.\n"
-                    "- **## Descripción**: Describe el tema en detalle, explicando qué es y cómo funciona.\n"
-                    "- **## Historia o Evolución**: Explica el origen o la evolución del tema a lo largo del tiempo.\n"
-                    "- **## Características Principales**: Detalla las características clave del tema.\n"
-                    "- **## Aplicaciones y Usos Prácticos**: Describe aplicaciones reales, con ejemplos concretos.\n"
-                    "- **## Beneficios**: Explica los beneficios del tema para los usuarios o la industria.\n"
-                    "- **## Limitaciones**: Analiza las limitaciones o desafíos asociados con el tema.\n"
-                    "- **## Consideraciones Éticas**: Aborda posibles riesgos éticos, como sesgos o problemas de privacidad (si aplica).\n"
-                    "- **## Comparación con Alternativas**: Compara el tema con otras soluciones o tecnologías similares.\n"
-                    "- **## Estudios de Caso**: Incluye un estudio de caso o ejemplo detallado de implementación.\n"
-                    "- **## Impacto Futuro**: Discute cómo el tema podría evolucionar en el futuro.\n"
-                    "- **## Recomendaciones**: Propón recomendaciones para su uso, implementación o mejora.\n"
-                    "- **## Conclusión**: Resume los puntos clave y destaca la importancia del tema.\n"
-                    "Asegúrate de incluir ejemplos prácticos, datos ficticios realistas, y análisis profundos en las secciones correspondientes."
-                )
-
-            if level in ['medio', 'profesional']:
-                system_message += (
-                    "\n- **Importante**: Para niveles medio y profesional, el documento debe incluir al menos un encabezado (por ejemplo, # Título, ## Subtítulo) "
-                    "para estructurar el contenido de manera clara."
-                )
-
-        if template in TEMPLATES and not is_conversational:
-            system_message += f" Usa esta plantilla como base:\n{TEMPLATES[template]}"
-
-        messages = [{"role": "system", "content": system_message}] + history + [{"role": "user", "content": prompt}]
-        cache_key = generate_cache_key(prompt, doc_type, template, fields, level, history)
-        max_tokens = 200 if is_conversational else {'basico': 1000, 'medio': 2000, 'profesional': 4000}[level]
+    async def generate(self, prompt: str, doc_type: str, template: str, fields: dict, level: str, language: str, history: list, session_id: str) -> tuple[str, bool]:
+        is_conversational = self.is_conversational_prompt(prompt)
+        messages = self._build_messages(prompt, template, level, language, history, session_id, is_conversational)
+        cache_key = generate_cache_key(prompt, doc_type, template, level, language, history)
+        max_tokens = 200 if is_conversational else MAX_TOKENS[level]
 
-        if cache_key in self.cache:
+        cached_text = await self.cache.get(cache_key)
+        if cached_text is not None:
             logging.info(f"Usando respuesta en caché para la clave: {cache_key}")
-            return self.cache[cache_key], is_conversational
+            return cached_text, is_conversational
 
         try:
-            response = self.client.chat.completions.create(
-                model="gpt-4o",
-                messages=messages,
-                max_tokens=max_tokens,
-                temperature=0.5
-            )
-            generated_text = response.choices[0].message.content.strip()
-            
-            is_valid, message = self.validate_generated_text(generated_text, level, is_conversational)
-            if not is_valid and not is_conversational:
-                logging.warning(f"Primer intento falló: {message}. Intentando regenerar con instrucciones más claras.")
-                messages[-1]["content"] += "\nPor favor, asegúrate de incluir al menos un encabezado (#, ##) en el contenido y seguir la estructura solicitada según el nivel."
-                response = self.client.chat.completions.create(
-                    model="gpt-4o",
-                    messages=messages,
-                    max_tokens=max_tokens,
-                    temperature=0.5
-                )
-                generated_text = response.choices[0].message.content.strip()
+            if level in ('medio', 'profesional') and not is_conversational:
+                generated_text = await self._generate_speculative(messages, max_tokens, level)
+            else:
+                generated_text = await self._complete(messages, max_tokens)
                 is_valid, message = self.validate_generated_text(generated_text, level, is_conversational)
-                if not is_valid:
-                    raise ValueError(f"Contenido generado no válido tras reintento: {message}")
+                if not is_valid and not is_conversational:
+                    logging.warning(f"Primer intento falló: {message}. Intentando regenerar con instrucciones más claras.")
+                    messages[-1]["content"] += STRICT_RETRY_SUFFIX
+                    generated_text = await self._complete(messages, max_tokens)
+                    is_valid, message = self.validate_generated_text(generated_text, level, is_conversational)
+                    if not is_valid:
+                        raise ValueError(f"Contenido generado no válido tras reintento: {message}")
 
             # Actualizar el contexto con el nuevo documento
             if not is_conversational:
-                self.conversation_context[session_id].update({
-                    'last_document': generated_text,
-                    'last_prompt': prompt,
-                    'last_doc_type': doc_type,
-                    'last_template': template,
-                    'last_level': level,
-                    'last_language': language
-                })
-
-            self.cache[cache_key] = generated_text
+                self._remember_document(session_id, generated_text, prompt, doc_type, template, level, language)
+
+            await self.cache.set(cache_key, generated_text)
             logging.info(f"Texto generado y almacenado en caché para la clave: {cache_key}")
             return generated_text, is_conversational
 
@@ -264,218 +589,304 @@ class DocumentGenerator:
             logging.error(f"Error inesperado al generar texto con OpenAI: {str(e)}")
             raise Exception(f"Error al generar el texto: {str(e)}")
 
+    async def generate_stream(self, prompt: str, doc_type: str, template: str, level: str, language: str, history: list, session_id: str):
+        """Como generate, pero entrega el texto por fragmentos a medida que llega de OpenAI.
+
+        No hay reintento: el texto ya enviado no se puede retirar. Solo se guarda en caché y
+        en el contexto si pasa la validación al cerrarse el stream.
+        """
+        is_conversational = self.is_conversational_prompt(prompt)
+        messages = self._build_messages(prompt, template, level, language, history, session_id, is_conversational)
+        cache_key = generate_cache_key(prompt, doc_type, template, level, language, history)
+        max_tokens = 200 if is_conversational else MAX_TOKENS[level]
+
+        cached_text = await self.cache.get(cache_key)
+        if cached_text is not None:
+            logging.info(f"Usando respuesta en caché para la clave: {cache_key}")
+            yield cached_text
+            return
+
+        await self.rate_limiter.acquire(max_tokens + sum(len(m["content"]) for m in messages) // 4)
+        stream = await self.aclient.chat.completions.create(
+            model="gpt-4o",
+            messages=messages,
+            max_tokens=max_tokens,
+            temperature=0.5,
+            stream=True
+        )
+        parts = []
+        async with stream:
+            async for chunk in stream:
+                if chunk.choices and chunk.choices[0].delta.content:
+                    parts.append(chunk.choices[0].delta.content)
+                    yield chunk.choices[0].delta.content
+
+        generated_text = "".join(parts).strip()
+        is_valid, message = self.validate_generated_text(generated_text, level, is_conversational)
+        if not is_valid:
+            logging.warning(f"Respuesta en streaming no válida, no se guarda en caché: {message}")
+            return
+        if not is_conversational:
+            self._remember_document(session_id, generated_text, prompt, doc_type, template, level, language)
+        await self.cache.set(cache_key, generated_text)
+
+    async def _complete(self, messages: list, max_tokens: int) -> str:
+        # Estimación aproximada del prompt: unos 4 caracteres por token
+        estimated_tokens = max_tokens + sum(len(m["content"]) for m in messages) // 4
+        for attempt in range(MAX_RATE_LIMIT_RETRIES + 1):
+            await self.rate_limiter.acquire(estimated_tokens)
+            try:
+                response = await self.aclient.chat.completions.create(
+                    model="gpt-4o",
+                    messages=messages,
+                    max_tokens=max_tokens,
+                    temperature=0.5
+                )
+                break
+            except RateLimitError:
+                if attempt == MAX_RATE_LIMIT_RETRIES:
+                    raise
+                delay = 2 ** attempt + random.random()
+                logging.warning(f"Límite de la API alcanzado; reintento {attempt + 1} en {delay:.1f} s")
+                await asyncio.sleep(delay)
+        usage = response.usage
+        if usage is not None:
+            details = usage.prompt_tokens_details
+            cached_tokens = details.cached_tokens if details and details.cached_tokens else 0
+            logging.info(f"Tokens de prompt: {usage.prompt_tokens} ({cached_tokens} reutilizados de la caché de OpenAI)")
+        return response.choices[0].message.content.strip()
+
+    async def _generate_speculative(self, messages: list, max_tokens: int, level: str) -> str:
+        """Lanza a la vez la petición normal y la de instrucciones estrictas y devuelve la primera válida.
+
+        Una petición que falla (tiempo de espera, error de la API) no cancela la otra; solo se
+        propaga el error si ninguna devuelve texto. Consume el doble de tokens que una petición.
+        """
+        strict_messages = messages[:-1] + [{"role": "user", "content": messages[-1]["content"] + STRICT_RETRY_SUFFIX}]
+        tasks = [asyncio.create_task(self._complete(m, max_tokens)) for m in (messages, strict_messages)]
+        message = None
+        error = None
+        try:
+            for next_done in asyncio.as_completed(tasks):
+                try:
+                    generated_text = await next_done
+                except Exception as e:
+                    logging.warning(f"Petición especulativa fallida: {str(e)}")
+                    error = e
+                    continue
+                is_valid, message = self.validate_generated_text(generated_text, level, False)
+                if is_valid:
+                    return generated_text
+                logging.warning(f"Respuesta especulativa descartada: {message}")
+        finally:
+            for task in tasks:
+                task.cancel()
+        if message is None:
+            # Ninguna petición devolvió texto; el error original lo traduce generate()
+            raise error
+        raise ValueError(f"Contenido generado no válido tras reintento: {message}")
+
+    async def submit_batch(self, jobs: list) -> str:
+        """Envía documentos sin usuario esperando a la Batch API de OpenAI (mitad de coste, plazo de 24 h).
+
+        Cada trabajo es un dict con 'id', 'prompt', 'level' y opcionalmente 'template' y 'language'.
+        Devuelve el id del lote para consultarlo después con poll_batch.
+        """
+        lines = []
+        for job in jobs:
+            level = job['level']
+            template = job.get('template')
+            system_message = _base_system_message(level, job.get('language', 'es'))
+            if template in TEMPLATES:
+                system_message += f" Usa esta plantilla como base:\n{TEMPLATES[template]}"
+            lines.append(json.dumps({
+                # El nivel va en el custom_id para poder validar la respuesta al recogerla
+                "custom_id": f"{level}:{job['id']}",
+                "method": "POST",
+                "url": "/v1/chat/completions",
+                "body": {
+                    "model": "gpt-4o",
+                    "messages": [
+                        {"role": "system", "content": system_message},
+                        {"role": "user", "content": job['prompt']}
+                    ],
+                    "max_tokens": MAX_TOKENS[level],
+                    "temperature": 0.5
+                }
+            }, ensure_ascii=False))
+
+        batch_file = await self.aclient.files.create(
+            file=("batch.jsonl", "\n".join(lines).encode('utf-8')),
+            purpose="batch"
+        )
+        batch = await self.aclient.batches.create(
+            input_file_id=batch_file.id,
+            endpoint="/v1/chat/completions",
+            completion_window="24h"
+        )
+        logging.info(f"Lote enviado a OpenAI: {batch.id} ({len(jobs)} documentos)")
+        return batch.id
+
+    async def poll_batch(self, batch_id: str) -> dict:
+        """Consulta un lote; si ha terminado, descarga y valida cada documento."""
+        batch = await self.aclient.batches.retrieve(batch_id)
+        if batch.status != 'completed':
+            return {'status': batch.status, 'results': {}}
+
+        output = await self.aclient.files.content(batch.output_file_id)
+        results = {}
+        for line in output.text.splitlines():
+            if not line.strip():
+                continue
+            item = json.loads(line)
+            level, job_id = item['custom_id'].split(':', 1)
+            response = item.get('response') or {}
+            if item.get('error') or response.get('status_code') != 200:
+                results[job_id] = {'text': None, 'valid': False, 'message': str(item.get('error') or response)}
+                continue
+            generated_text = response['body']['choices'][0]['message']['content'].strip()
+            is_valid, message = self.validate_generated_text(generated_text, level, False)
+            results[job_id] = {'text': generated_text, 'valid': is_valid, 'message': message}
+        return {'status': batch.status, 'results': results}
+
     def extract_docx_content(self, doc):
         """Extrae el contenido de un documento DOCX como texto plano para la vista previa."""
-        text = []
+        buf = io.StringIO()
         section_number = 0
         subsection_number = 0
 
         for para in doc.paragraphs:
-            if para.text.strip():
-                style_name = para.style.name.lower() if para.style else 'normal'
-                formatted_text = para.text.strip()
-
-                if 'heading 1' in style_name:
-                    section_number += 1
-                    subsection_number = 0
-                    formatted_text = f"\n\n{section_number}. {formatted_text}\n"
-                elif 'heading 2' in style_name:
-                    subsection_number += 1
-                    formatted_text = f"\n{section_number}.{subsection_number} {formatted_text}\n"
-                elif 'heading 3' in style_name:
-                    formatted_text = f"{formatted_text}\n"
-                elif 'list bullet' in style_name or 'list number' in style_name:
-                    indent_level = para.paragraph_format.left_indent.inches / 0.5 if para.paragraph_format.left_indent else 0
-                    indent = "  " * int(indent_level)
-                    formatted_text = f"{indent}- {formatted_text}"
-                else:
-                    formatted_text = f"{formatted_text}"
+            formatted_text = para.text.strip()
+            if not formatted_text:
+                continue
+            style = para.style
+            kind = _PREVIEW_KINDS.get(style.name.lower() if style is not None else 'normal')
 
-                text.append(formatted_text)
+            if kind == 'h1':
+                section_number += 1
+                subsection_number = 0
+                buf.write(f"\n\n{section_number}. {formatted_text}\n")
+            elif kind == 'h2':
+                subsection_number += 1
+                buf.write(f"\n{section_number}.{subsection_number} {formatted_text}\n")
+            elif kind == 'h3':
+                buf.write(f"{formatted_text}\n")
+            elif kind == 'li':
+                left_indent = para.paragraph_format.left_indent
+                # Cada nivel de lista equivale a media pulgada (457200 EMU)
+                indent_level = left_indent // _HALF_INCH_EMU if left_indent else 0
+                buf.write(f"{'  ' * indent_level}- {formatted_text}")
+            else:
+                buf.write(formatted_text)
+            buf.write("\n")
 
         for table in doc.tables:
-            text.append("\n[Tabla]\n")
+            buf.write("\n[Tabla]\n\n")
             for row in table.rows:
-                row_text = []
-                for cell in row.cells:
-                    cell_text = cell.text.strip()
-                    if cell_text:
-                        row_text.append(cell_text)
+                row_text = [cell_text for cell_text in (cell.text.strip() for cell in row.cells) if cell_text]
                 if row_text:
-                    text.append(" | ".join(row_text))
-            text.append("\n")
+                    buf.write(" | ".join(row_text))
+                    buf.write("\n")
+            buf.write("\n\n")
 
-        return "\n".join(text).strip()
+        return buf.getvalue().strip()
 
     def parse_markdown_for_docx(self, doc, text: str, language: str, logo_path: str = None):
         """Convierte texto Markdown en un documento DOCX con estilos mejorados."""
-        # Definir estilos personalizados
-        styles = doc.styles
-
-        # Estilo para Heading 1 (secciones numeradas)
-        if 'CustomHeading1' not in styles:
-            h1_style = styles.add_style('CustomHeading1', WD_STYLE_TYPE.PARAGRAPH)
-            h1_style.font.name = 'Calibri'
-            h1_style.font.size = Pt(16)
-            h1_style.font.bold = True
-            h1_style.font.color.rgb = RGBColor(79, 70, 229)  # Color #4f46e5
-            h1_style.paragraph_format.space_after = Pt(12)
-            h1_style.paragraph_format.space_before = Pt(18)
-
-        # Estilo para Heading 2 (subsecciones numeradas)
-        if 'CustomHeading2' not in styles:
-            h2_style = styles.add_style('CustomHeading2', WD_STYLE_TYPE.PARAGRAPH)
-            h2_style.font.name = 'Calibri'
-            h2_style.font.size = Pt(14)
-            h2_style.font.bold = True
-            h2_style.font.color.rgb = RGBColor(79, 70, 229)
-            h2_style.paragraph_format.space_after = Pt(10)
-            h2_style.paragraph_format.space_before = Pt(12)
-
-        # Estilo para Heading 3
-        if 'CustomHeading3' not in styles:
-            h3_style = styles.add_style('CustomHeading3', WD_STYLE_TYPE.PARAGRAPH)
-            h3_style.font.name = 'Calibri'
-            h3_style.font.size = Pt(12)
-            h3_style.font.bold = True
-            h3_style.font.color.rgb = RGBColor(79, 70, 229)
-            h3_style.paragraph_format.space_after = Pt(8)
-            h3_style.paragraph_format.space_before = Pt(8)
-
-        # Estilo para párrafos
-        if 'CustomNormal' not in styles:
-            normal_style = styles.add_style('CustomNormal', WD_STYLE_TYPE.PARAGRAPH)
-            normal_style.font.name = 'Calibri'
-            normal_style.font.size = Pt(11)
-            normal_style.paragraph_format.line_spacing = 1.15
-            normal_style.paragraph_format.space_after = Pt(6)
-            normal_style.paragraph_format.alignment = WD_ALIGN_PARAGRAPH.JUSTIFY
-
-        # Estilo para listas
-        if 'CustomList' not in styles:
-            list_style = styles.add_style('CustomList', WD_STYLE_TYPE.PARAGRAPH)
-            list_style.font.name = 'Calibri'
-            list_style.font.size = Pt(11)
-            list_style.paragraph_format.line_spacing = 1.15
-            list_style.paragraph_format.space_after = Pt(6)
-            list_style.paragraph_format.alignment = WD_ALIGN_PARAGRAPH.JUSTIFY
-            list_style.paragraph_format.left_indent = Inches(0.5)
+        from docx.shared import Pt, Inches
+        from docx.enum.text import WD_ALIGN_PARAGRAPH
+        from docx.oxml import parse_xml
+        from docx.oxml.ns import nsdecls
+        _ensure_styles(doc)
 
         # Añadir logotipo si existe
-        if logo_path and os.path.exists(logo_path):
+        if logo_ok(logo_path):
             paragraph = doc.add_paragraph()
             paragraph.alignment = WD_ALIGN_PARAGRAPH.CENTER
             run = paragraph.add_run()
             run.add_picture(logo_path, width=Inches(1.5))
             paragraph.paragraph_format.space_after = Pt(12)
 
-        # Procesar el texto Markdown
-        lines = text.split('\n')
+        # Procesar el texto Markdown: los párrafos y tablas se generan como XML
+        # y se insertan en el cuerpo del documento de una sola vez
+        section = doc.sections[-1]
+        width_twips = (section.page_width - section.left_margin - section.right_margin) // _EMU_PER_TWIP
+        parts = []
         section_number = 0
         subsection_number = 0
-        in_list = False
-        list_level = 0
-        in_table = False
         table_data = []
+        chart_data = None
+        chart_type = None
 
-        for line in lines:
-            line = line.strip()
+        for raw_line in text.split('\n'):
+            line = raw_line.strip()
             if not line:
-                if in_table:
-                    if table_data:
-                        self._add_table_to_docx(doc, table_data)
-                        table_data = []
-                        in_table = False
+                if table_data:
+                    parts.append(_table_xml(table_data, width_twips))
+                    table_data = []
                 continue
 
-            # Manejar encabezados
-            if line.startswith('# '):
-                section_number += 1
-                subsection_number = 0
-                section_title = f"{section_number}. {line[2:].strip()}"
-                doc.add_paragraph(section_title, style='CustomHeading1')
-                in_list = False
-                continue
-            elif line.startswith('## '):
-                subsection_number += 1
-                subsection_title = f"{section_number}.{subsection_number} {line[3:].strip()}"
-                doc.add_paragraph(subsection_title, style='CustomHeading2')
-                in_list = False
-                continue
-            elif line.startswith('### '):
-                doc.add_paragraph(line[4:].strip(), style='CustomHeading3')
-                in_list = False
+            # Las directivas de gráfico no se escriben; el último gráfico se añade al final, como en el PDF
+            chart = parse_chart_line(line)
+            if chart is not None:
+                chart_type, chart_data = chart
                 continue
 
-            # Manejar listas
-            if line.startswith('- ') or line.startswith('* '):
-                if not in_list:
-                    in_list = True
-                    list_level = 1
-                paragraph = doc.add_paragraph(line[2:].strip(), style='CustomList')
-                paragraph.paragraph_format.left_indent = Inches(0.5 * list_level)
-                continue
-            elif line.startswith('  - ') or line.startswith('  * '):
-                if not in_list:
-                    in_list = True
-                    list_level = 2
-                else:
-                    list_level = 2
-                paragraph = doc.add_paragraph(line[4:].strip(), style='CustomList')
-                paragraph.paragraph_format.left_indent = Inches(0.5 * list_level)
-                continue
-            else:
-                in_list = False
-                list_level = 0
+            match = _MD_LINE.match(line)
+            kind = match.lastgroup if match else None
+
+            # Cualquier línea que no sea de tabla cierra la tabla pendiente
+            if kind != 'tbl' and table_data:
+                parts.append(_table_xml(table_data, width_twips))
+                table_data = []
 
-            # Manejar tablas
-            if line.startswith('|'):
-                in_table = True
+            if kind == 'h1':
+                section_number += 1
+                subsection_number = 0
+                parts.append(_paragraph_xml(f"{section_number}. {line[2:].strip()}", 'CustomHeading1'))
+            elif kind == 'h2':
+                subsection_number += 1
+                parts.append(_paragraph_xml(f"{section_number}.{subsection_number} {line[3:].strip()}", 'CustomHeading2'))
+            elif kind == 'h3':
+                parts.append(_paragraph_xml(line[4:].strip(), 'CustomHeading3'))
+            elif kind == 'li':
+                # Los elementos sangrados en el texto original son de segundo nivel
+                list_level = 2 if raw_line[:1].isspace() else 1
+                parts.append(_paragraph_xml(line[2:].strip(), 'CustomList', _LIST_INDENT_TWIPS * list_level))
+            elif kind == 'tbl':
                 cells = [cell.strip() for cell in line.split('|') if cell.strip()]
                 if cells:
                     table_data.append(cells)
-                continue
-            elif in_table:
-                if table_data:
-                    self._add_table_to_docx(doc, table_data)
-                    table_data = []
-                    in_table = False
-
-            # Párrafos normales
-            doc.add_paragraph(line, style='CustomNormal')
+            else:
+                parts.append(_paragraph_xml(line, 'CustomNormal'))
 
         # Añadir la última tabla si existe
-        if in_table and table_data:
-            self._add_table_to_docx(doc, table_data)
-
-    def _add_table_to_docx(self, doc, table_data):
-        """Añade una tabla al documento DOCX con formato mejorado."""
-        if not table_data:
-            return
+        if table_data:
+            parts.append(_table_xml(table_data, width_twips))
+
+        if parts:
+            fragment = parse_xml(f'<w:body {nsdecls("w")}>{"".join(parts)}</w:body>')
+            body = doc.element.body
+            # Todo el contenido va antes de la sección final (w:sectPr)
+            position = body.index(body.sectPr) if body.sectPr is not None else len(body)
+            body[position:position] = list(fragment)
+
+        if chart_data:
+            # Se inserta a 5 pulgadas de ancho: a 72 ppp basta con 5x3.3 para no guardar píxeles de más
+            chart_buffer = generate_chart(chart_data, chart_type, dpi=72, figsize=(5, 3.3))
+            if chart_buffer.getvalue():
+                doc.add_picture(chart_buffer, width=Inches(5))
+                doc.paragraphs[-1].alignment = WD_ALIGN_PARAGRAPH.CENTER
+            else:
+                logging.warning("Buffer de gráfico vacío, no se añadió al DOCX")
 
-        table = doc.add_table(rows=len(table_data), cols=len(table_data[0]))
-        table.style = 'Table Grid'
-        table.autofit = True
-
-        for i, row_data in enumerate(table_data):
-            for j, cell_text in enumerate(row_data):
-                cell = table.cell(i, j)
-                cell.text = cell_text
-                paragraph = cell.paragraphs[0]
-                paragraph.style = 'CustomNormal'
-                if i == 0:  # Encabezado
-                    paragraph.runs[0].font.bold = True
-                    paragraph.runs[0].font.color.rgb = RGBColor(255, 255, 255)
-                    cell._element.get_or_add_tcPr().append(doc.element.xpath('//w:tcPr')[0].cloneNode(True))
-                    shading_elm = parse_xml(r'<w:shd {} w:fill="4f46e5"/>'.format(nsdecls('w')))
-                    cell._element.get_or_add_tcPr().append(shading_elm)
-
-        # Ajustar el espaciado después de la tabla
-        doc.add_paragraph().paragraph_format.space_before = Pt(12)
-
-    def render(self, text: str, doc_type: str, language: str, file_name: str, logo_path: str = None) -> tuple:
+    def render(self, text: str, doc_type: str, language: str, file_name: str, logo_path: str = None,
+               out: IO[bytes] = None, want_preview: bool = False) -> tuple:
+        """Renderiza el texto en el formato pedido. Si se pasa `out`, el archivo se escribe
+        directamente en ese flujo (respuesta HTTP, archivo temporal...) en lugar de en un BytesIO.
+        `preview_content` solo se calcula cuando `want_preview` es True."""
         try:
-            buffer = io.BytesIO()
+            buffer = out if out is not None else io.BytesIO()
             file_id = None
             response = text
             mime_type = None
@@ -487,13 +898,13 @@ class DocumentGenerator:
                 full_file_name = f"{file_name}.txt"
                 buffer.write(text.encode('utf-8'))
             elif doc_type == 'markdown':
-                response = markdown.markdown(text, extensions=['tables', 'fenced_code', 'nl2br'])
+                response = _render_md(text, nl2br=True)
                 mime_type = 'text/markdown'
                 full_file_name = f"{file_name}.md"
-                preview_content = response
+                if want_preview:
+                    preview_content = response
                 buffer.write(response.encode('utf-8'))
             elif doc_type in ['pdf', 'docx', 'html']:
-                file_id = str(uuid.uuid4())
                 mime_types = {
                     'pdf': 'application/pdf',
                     'docx': 'application/vnd.openxmlformats-officedocument.wordprocessingml.document',
@@ -502,6 +913,9 @@ class DocumentGenerator:
                 mime_type = mime_types[doc_type]
 
                 if doc_type == 'pdf':
+                    from reportlab.lib.pagesizes import letter
+                    from reportlab.platypus import SimpleDocTemplate
+                    from reportlab.lib.units import inch as reportlab_inch
                     doc = SimpleDocTemplate(
                         buffer,
                         pagesize=letter,
@@ -510,23 +924,12 @@ class DocumentGenerator:
                         topMargin=1 * reportlab_inch,
                         bottomMargin=1 * reportlab_inch
                     )
-                    styles = getSampleStyleSheet()
-                    styles['Heading1'].fontSize = 16
-                    styles['Heading1'].leading = 20
-                    styles['Heading1'].spaceAfter = 12
-                    styles['Heading1'].fontName = 'Helvetica-Bold'
-                    styles['Heading2'].fontSize = 14
-                    styles['Heading2'].leading = 18
-                    styles['Heading2'].spaceAfter = 10
-                    styles['Heading2'].fontName = 'Helvetica-Bold'
-                    styles['Heading3'].fontSize = 12
-                    styles['Heading3'].leading = 16
-                    styles['Heading3'].spaceAfter = 8
-                    styles['Heading3'].fontName = 'Helvetica-Bold'
-                    story = parse_markdown_for_pdf(text, styles, language, logo_path)
+                    # Los estilos del PDF se configuran una vez en utils (_pdf_styles)
+                    story = parse_markdown_for_pdf(text, language, logo_path)
                     doc.build(story)
                     response = "PDF generado. Usa el botón de descargar para obtener el archivo."
                 elif doc_type == 'docx':
+                    from docx import Document
                     doc = Document()
                     TWIPS_PER_INCH = 1440
                     doc.sections[0].left_margin = int(1 * TWIPS_PER_INCH)
@@ -535,156 +938,24 @@ class DocumentGenerator:
                     doc.sections[0].bottom_margin = int(1 * TWIPS_PER_INCH)
                     self.parse_markdown_for_docx(doc, text, language, logo_path)
                     doc.save(buffer)
-                    preview_content = self.extract_docx_content(doc)
+                    if want_preview:
+                        # La vista previa se entrega ya compactada; las rutas la pasan tal cual
+                        preview_content = self.extract_docx_content(doc).replace('\n\n', '\n').strip()
                     response = "DOCX generado. Usa el botón de descargar para obtener el archivo."
                 elif doc_type == 'html':
-                    html_content = f"""
-                    <!DOCTYPE html>
-                    <html lang="{language}">
-                    <head>
-                        <meta charset="UTF-8">
-                        <title>{file_name}</title>
-                        <style>
-                            body {{ 
-                                font-family: 'Calibri', sans-serif; 
-                                margin: 40px auto; 
-                                line-height: 1.6; 
-                                max-width: 900px; 
-                                padding: 0 20px; 
-                                color: #333; 
-                                background-color: #f9f9f9; 
-                            }}
-                            h1 {{ 
-                                color: #4f46e5; 
-                                font-size: 32px; 
-                                border-bottom: 3px solid #4f46e5; 
-                                padding-bottom: 8px; 
-                                margin-bottom: 25px; 
-                                text-align: center; 
-                            }}
-                            h2 {{ 
-                                color: #4f46e5; 
-                                font-size: 24px; 
-                                margin-top: 30px; 
-                                margin-bottom: 15px; 
-                                border-left: 5px solid #4f46e5; 
-                                padding-left: 10px; 
-                            }}
-                            h3 {{ 
-                                color: #4f46e5; 
-                                font-size: 20px; 
-                                margin-top: 20px; 
-                                margin-bottom: 10px; 
-                            }}
-                            ul, ol {{ 
-                                margin: 15px 0; 
-                                padding-left: 30px; 
-                            }}
-                            li {{ 
-                                margin-bottom: 10px; 
-                            }}
-                            table {{ 
-                                border-collapse: collapse; 
-                                width: 100%; 
-                                margin: 20px 0; 
-                                box-shadow: 0 3px 8px rgba(0,0,0,0.1); 
-                                background-color: #fff; 
-                            }}
-                            th, td {{ 
-                                border: 1px solid #ddd; 
-                                padding: 12px; 
-                                text-align: left; 
-                            }}
-                            th {{ 
-                                background-color: #f0f0f0; 
-                                font-weight: bold; 
-                                color: #333; 
-                            }}
-                            p {{ 
-                                margin: 12px 0; 
-                                text-align: justify; 
-                                font-size: 16px; 
-                            }}
-                            .info-box, .config-box {{ 
-                                background-color: #fff; 
-                                border: 2px solid #4f46e5; 
-                                border-radius: 8px; 
-                                padding: 20px; 
-                                margin: 20px 0; 
-                                box-shadow: 0 3px 8px rgba(0,0,0,0.1); 
-                            }}
-                            .info-box h2, .config-box h2 {{ 
-                                margin-top: 0; 
-                                border-left: none; 
-                                padding-left: 0; 
-                            }}
-                            .config-box table {{ 
-                                box-shadow: none; 
-                                margin: 0; 
-                            }}
-                            hr {{ 
-                                border: 0; 
-                                border-top: 1px solid #ddd; 
-                                margin: 20px 0; 
-                            }}
-                        </style>
-                    </head>
-                    <body>
-                        <h1>{file_name}</h1>
-                        <div class="info-box">
-                            <h2>Información sobre la IA</h2>
-                            <p>
-                                Este documento fue generado por <strong>GarbotGPT</strong>, una IA desarrollada por GarolaCorp. GarBotGPT está diseñado para asistir a los usuarios en la creación de documentos profesionales y bien estructurados, ofreciendo respuestas útiles y precisas. Este documento se generó utilizando un modelo avanzado de IA con parámetros optimizados para claridad y profesionalismo.
-                            </p>
-                            <p>
-                                <strong>Fecha de Generación:</strong> 05 de Mayo de 2025<br>
-                                <strong>Idioma:</strong> {language.upper()}<br>
-                                <strong>Plataforma:</strong> GarBotGPT Generador de documentos
-                            </p>
-                        </div>
-                        <div class="config-box">
-                            <h2>Configuración del Documento</h2>
-                            <p>A continuación, se detalla la configuración utilizada para generar este documento:</p>
-                            <table>
-                                <tr>
-                                    <th>Parámetro</th>
-                                    <th>Valor</th>
-                                </tr>
-                                <tr>
-                                    <td>Fuente Principal</td>
-                                    <td>Calibri</td>
-                                </tr>
-                                <tr>
-                                    <td>Tamaño de Fuente</td>
-                                    <td>16px (Encabezados), 11px (Cuerpo)</td>
-                                </tr>
-                                <tr>
-                                    <td>Color Principal</td>
-                                    <td>#4f46e5</td>
-                                </tr>
-                                <tr>
-                                    <td>Márgenes</td>
-                                    <td>1 pulgada (todos los lados)</td>
-                                </tr>
-                                <tr>
-                                    <td>Tema</td>
-                                    <td>Moderno (Claro)</td>
-                                </tr>
-                                <tr>
-                                    <td>Espaciado de Líneas</td>
-                                    <td>1.15</td>
-                                </tr>
-                            </table>
-                        </div>
-                        <hr>
-                        {markdown.markdown(text, extensions=['tables', 'fenced_code'])}
-                    </body>
-                    </html>
-                    """
+                    html_content = _HTML_TEMPLATE.render(file_name=file_name, language=language, body=_render_md(text))
                     buffer.write(html_content.encode('utf-8'))
                     response = html_content
-                    preview_content = html_content
-                buffer.seek(0)
+                    if want_preview:
+                        preview_content = html_content
+                if out is None:
+                    # El id es un resumen del contenido: el mismo documento generado dos veces
+                    # ocupa una sola entrada en la caché de descargas
+                    file_id = blake2b(buffer.getbuffer(), digest_size=12).hexdigest()
+                    buffer.seek(0)
+                else:
+                    # Un flujo externo no se puede releer para resumirlo
+                    file_id = uuid.uuid4().hex
             else:
                 logging.warning(f"Tipo de documento no soportado: {doc_type}")
                 raise ValueError(f"Tipo de documento no soportado: {doc_type}")
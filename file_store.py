@@ -0,0 +1,37 @@
+# file_store.py
+import io
+import os
+import tempfile
+import weakref
+
+# Por encima de este tamaño el documento se guarda en disco en lugar de en memoria
+SPOOL_MAX_SIZE = 64 * 1024
+
+class StoredFile:
+    """Documento renderizado pendiente de descarga.
+
+    Los documentos pequeños se guardan como bytes; los grandes se vuelcan a un archivo
+    temporal que se borra cuando la entrada sale de la caché y deja de estar referenciada.
+    Cada descarga abre su propio lector, así que se puede descargar varias veces y
+    atender peticiones Range en paralelo.
+    """
+
+    def __init__(self, buffer: io.BytesIO, file_name: str, mime_type: str):
+        self.file_name = file_name
+        self.mime_type = mime_type
+        data = buffer.getbuffer()
+        self.size = data.nbytes
+        if self.size <= SPOOL_MAX_SIZE:
+            self.data = bytes(data)
+            self.path = None
+        else:
+            with tempfile.NamedTemporaryFile(prefix='doc_', delete=False) as tmp:
+                tmp.write(data)
+            self.data = None
+            self.path = tmp.name
+            weakref.finalize(self, os.unlink, tmp.name)
+        data.release()
+
+    def open(self):
+        """Ruta del archivo en disco o un BytesIO nuevo, listo para send_file."""
+        return self.path if self.path is not None else io.BytesIO(self.data)
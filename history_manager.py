@@ -1,32 +1,95 @@
 # history_manager.py
+import os
+import queue
 import sqlite3
 from datetime import datetime
 
+DB_PATH = 'history.db'
+
+# WAL permite lecturas concurrentes con una escritura y evita un fsync por transacción
+_PRAGMAS = (
+    'PRAGMA journal_mode=WAL',
+    'PRAGMA synchronous=NORMAL',
+    'PRAGMA temp_store=MEMORY',
+    'PRAGMA mmap_size=268435456',
+)
+
+# Sentencias SQL fijas: el mismo texto en cada llamada reutiliza la sentencia preparada
+# de la caché de la conexión
+_SQL_INSERT_HIST = 'INSERT INTO history VALUES (?, ?, ?, ?)'
+_SQL_SEL_HIST = '''SELECT role, content FROM
+                    (SELECT rowid AS id, role, content, timestamp FROM history
+                     WHERE session_id = ? ORDER BY timestamp DESC, rowid DESC LIMIT 20)
+                  ORDER BY timestamp ASC, id ASC'''
+_SQL_DEL_HIST = 'DELETE FROM history WHERE session_id = ?'
+_SQL_UPSERT_TEMPLATE = 'INSERT OR REPLACE INTO templates (name, content) VALUES (?, ?)'
+_SQL_SEL_TEMPLATES = 'SELECT name, content FROM templates'
+_SQL_SEL_TRANSLATION = 'SELECT value FROM translations WHERE key = ?'
+_SQL_UPSERT_TRANSLATION = 'INSERT OR REPLACE INTO translations (key, value) VALUES (?, ?)'
+
+# Conexiones reutilizadas entre peticiones; una por hilo de trabajo como máximo
+_pool = queue.LifoQueue(maxsize=int(os.getenv('DB_POOL_SIZE', '8')))
+
+def _connect() -> sqlite3.Connection:
+    conn = sqlite3.connect(DB_PATH, check_same_thread=False, cached_statements=256)
+    conn.row_factory = sqlite3.Row
+    for pragma in _PRAGMAS:
+        conn.execute(pragma)
+    return conn
+
+def acquire_connection() -> sqlite3.Connection:
+    """Toma una conexión del pool o abre una nueva si están todas en uso."""
+    try:
+        return _pool.get_nowait()
+    except queue.Empty:
+        return _connect()
+
+def release_connection(conn: sqlite3.Connection) -> None:
+    """Devuelve la conexión al pool; si ya está lleno, la cierra."""
+    try:
+        _pool.put_nowait(conn)
+    except queue.Full:
+        conn.close()
+
 def init_db():
-    conn = sqlite3.connect('history.db')
+    conn = sqlite3.connect(DB_PATH)
     c = conn.cursor()
     c.execute('''CREATE TABLE IF NOT EXISTS history
                  (session_id TEXT, role TEXT, content TEXT, timestamp DATETIME)''')
     c.execute('''CREATE TABLE IF NOT EXISTS templates
                  (name TEXT PRIMARY KEY, content TEXT)''')
+    c.execute('''CREATE TABLE IF NOT EXISTS translations
+                 (key TEXT PRIMARY KEY, value TEXT)''')
+    c.execute('CREATE INDEX IF NOT EXISTS idx_history_sid_ts ON history(session_id, timestamp)')
     conn.commit()
     conn.close()
 
 def save_history(db, session_id: str, role: str, content: str) -> None:
-    db.execute('INSERT INTO history VALUES (?, ?, ?, ?)',
-               (session_id, role, content, datetime.now()))
+    db.execute(_SQL_INSERT_HIST, (session_id, role, content, datetime.now()))
+
+def save_history_batch(db, rows: list) -> None:
+    """Inserta varias filas (session_id, role, content, timestamp) con una sola sentencia."""
+    db.executemany(_SQL_INSERT_HIST, rows)
 
 def get_history(db, session_id: str) -> list:
-    cursor = db.execute('SELECT role, content FROM history WHERE session_id = ? ORDER BY timestamp ASC', (session_id,))
-    history = [{'role': role, 'content': content} for role, content in cursor.fetchall()][-20:]
-    return history
+    # Solo las 20 filas más recientes, leídas por el índice y devueltas en orden cronológico;
+    # rowid desempata las filas guardadas en lote con la misma marca de tiempo
+    cursor = db.execute(_SQL_SEL_HIST, (session_id,))
+    return [{'role': role, 'content': content} for role, content in cursor]
 
 def clear_history(db, session_id: str) -> None:
-    db.execute('DELETE FROM history WHERE session_id = ?', (session_id,))
+    db.execute(_SQL_DEL_HIST, (session_id,))
 
 def save_template(db, name: str, content: str) -> None:
-    db.execute('INSERT OR REPLACE INTO templates (name, content) VALUES (?, ?)', (name, content))
+    db.execute(_SQL_UPSERT_TEMPLATE, (name, content))
 
 def get_templates(db) -> list:
-    cursor = db.execute('SELECT name, content FROM templates')
-    return [{'name': name, 'content': content} for name, content in cursor.fetchall()]
\ No newline at end of file
+    cursor = db.execute(_SQL_SEL_TEMPLATES)
+    return [{'name': name, 'content': content} for name, content in cursor]
+
+def get_translation(db, key: str):
+    row = db.execute(_SQL_SEL_TRANSLATION, (key,)).fetchone()
+    return row[0] if row is not None else None
+
+def save_translation(db, key: str, value: str) -> None:
+    db.execute(_SQL_UPSERT_TRANSLATION, (key, value))
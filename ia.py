@@ -1,14 +1,24 @@
-from flask import Flask, request, jsonify, render_template, send_file, session, g
+from flask import Flask, Response, request, jsonify, render_template, send_file, session, g, stream_with_context
 from dotenv import load_dotenv
+from werkzeug.utils import secure_filename
 import os
+import json
+import asyncio
 import logging
-import sqlite3
-import markdown
+import tempfile
+import threading
+import uuid
+from concurrent.futures import Future, ThreadPoolExecutor
+from hashlib import blake2b
+from datetime import datetime
 from cachetools import TTLCache
-from config import VALID_DOC_TYPES, VALID_TEMPLATES, VALID_LEVELS, VALID_LANGUAGES, MAX_PROMPT_LENGTH, MAX_FIELD_LENGTH, TEMPLATES
-from utils import generate_file_name, sanitize_fields
-from history_manager import init_db, save_history, get_history, clear_history, save_template, get_templates
+from config import (VALID_DOC_TYPES, VALID_TEMPLATES, VALID_LEVELS, VALID_LANGUAGES, is_valid_doc_type,
+                    validate_combo, CHECK_PROMPT, CHECK_FIELD,
+                    TEMPLATES, REQUIRED_TEMPLATE_FIELDS, GENERATED_FIELD, TEMPLATE_RENDERERS)
+from utils import configure_logging, generate_file_name, sanitize_fields
+from history_manager import acquire_connection, release_connection, init_db, save_history_batch, get_history, clear_history, save_template, get_templates
 from document_generator import DocumentGenerator
+from file_store import StoredFile
 
 app = Flask(__name__)
 load_dotenv()
@@ -17,30 +27,84 @@ if not app.secret_key:
     logging.error("Clave secreta de Flask no encontrada")
     raise ValueError("Clave secreta de Flask no configurada")
 
-logging.basicConfig(level=logging.INFO, filename='app.log', format='%(asctime)s - %(levelname)s - %(message)s')
+configure_logging()
 
-generator = DocumentGenerator(api_key=os.getenv("OPENAI_API_KEY"))
+generator = DocumentGenerator(
+    api_key=os.getenv("OPENAI_API_KEY"),
+    max_requests_per_minute=int(os.getenv("OPENAI_MAX_RPM", "500")),
+    max_tokens_per_minute=int(os.getenv("OPENAI_MAX_TPM", "30000"))
+)
+# Documentos pendientes de descarga; los grandes se guardan en disco (ver file_store).
+# Viven en la memoria del proceso, así que la aplicación se sirve con un solo worker
+# (ver wsgi.py). TTLCache no es seguro entre hilos: todo acceso va bajo file_storage_lock
 file_storage = TTLCache(maxsize=100, ttl=3600)
+file_storage_lock = threading.Lock()
+
+# Los PDF se renderizan fuera de la petición: /generate y /preview devuelven el file_id al
+# momento y /download responde 202 hasta que el archivo está listo. DOCX y HTML siguen en
+# línea porque la respuesta incluye su vista previa
+render_pool = ThreadPoolExecutor(max_workers=int(os.getenv("RENDER_WORKERS", "4")), thread_name_prefix='render')
+BACKGROUND_DOC_TYPES = frozenset({'pdf'})
+RENDERING_MESSAGE = "Generando el PDF. Estará disponible para descargar en unos segundos."
+
+UPLOAD_DIR = 'uploads'
+UPLOAD_CHUNK_SIZE = 64 * 1024
 
 def get_db():
     if 'db' not in g:
-        g.db = sqlite3.connect('history.db')
-        g.db.row_factory = sqlite3.Row
+        g.db = acquire_connection()
     return g.db
 
 @app.teardown_appcontext
 def close_db(error):
     db = g.pop('db', None)
     if db is not None:
-        db.commit()
-        db.close()
+        # Las rutas que escriben confirman ellas mismas; lo que quede abierto (p. ej. tras
+        # un error) se descarta para no devolver al pool una conexión con transacción
+        if db.in_transaction:
+            db.rollback()
+        release_connection(db)
 
 init_db()
 
+def _new_sid() -> str:
+    return os.urandom(16).hex()
+
+@app.before_request
+def load_session_id():
+    # Se resuelve una vez por petición; el id aleatorio solo se genera si la sesión no tiene uno
+    g.session_id = session['session_id'] if 'session_id' in session else _new_sid()
+
+def _render_to_storage(text: str, doc_type: str, language: str, file_name: str, logo_path: str = None) -> tuple:
+    """Renderiza en el pool y devuelve (file_id por contenido, StoredFile)."""
+    _, file_id, buffer, mime_type, full_file_name, _ = generator.render(text, doc_type, language, file_name, logo_path)
+    return file_id, StoredFile(buffer, full_file_name, mime_type)
+
+def enqueue_render(text: str, doc_type: str, language: str, file_name: str, logo_path: str = None) -> str:
+    """Encola el renderizado y devuelve el file_id con el que se sondea /download.
+
+    El id de sondeo es aleatorio porque el resumen del contenido no existe hasta que termina
+    el renderizado; al terminar, el archivo se guarda también bajo ese resumen.
+    """
+    file_id = uuid.uuid4().hex
+    future = render_pool.submit(_render_to_storage, text, doc_type, language, file_name, logo_path)
+    with file_storage_lock:
+        file_storage[file_id] = future
+    return file_id
+
+# Campos validados contra su conjunto de valores; los mensajes de error se resuelven una sola vez
+_VALIDATORS = (
+    ('doc_type', VALID_DOC_TYPES, 'Tipo de documento inválido'),
+    ('template', VALID_TEMPLATES, 'Plantilla inválida'),
+    ('level', VALID_LEVELS, 'Nivel inválido'),
+    ('language', VALID_LANGUAGES, 'Idioma inválido'),
+)
+_ERR = {key: f'{label}: {", ".join(sorted(allowed))}' for key, allowed, label in _VALIDATORS}
+
 def validate_input(data: dict) -> tuple:
     prompt = data.get('prompt', '').strip()
     doc_type = data.get('doc_type', 'texto').lower()
-    template = data.get('template', '').lower()
+    template = data.get('template', '').lower() or None
     fields = sanitize_fields(data.get('fields', {}))
     level = data.get('level', 'basico').lower()
     language = data.get('language', 'es').lower()
@@ -49,46 +113,44 @@ def validate_input(data: dict) -> tuple:
 
     if not prompt:
         raise ValueError('El prompt está vacío.')
-    if len(prompt) > MAX_PROMPT_LENGTH:
-        raise ValueError(f'El prompt excede el límite de {MAX_PROMPT_LENGTH} caracteres.')
-    if doc_type not in VALID_DOC_TYPES:
-        raise ValueError(f'Tipo de documento inválido: {", ".join(VALID_DOC_TYPES)}')
-    if template and template not in VALID_TEMPLATES:
-        raise ValueError(f'Plantilla inválida: {", ".join(VALID_TEMPLATES)}')
-    if level not in VALID_LEVELS:
-        raise ValueError(f'Nivel inválido: {", ".join(VALID_LEVELS)}')
-    if language not in VALID_LANGUAGES:
-        raise ValueError(f'Idioma inválido: {", ".join(VALID_LANGUAGES)}')
+    CHECK_PROMPT(prompt)
+    # Solo se repasa campo a campo si la combinación no es válida, para dar el error concreto
+    if not validate_combo(doc_type, template, level, language):
+        values = {'doc_type': doc_type, 'template': template, 'level': level, 'language': language}
+        for key, allowed, _ in _VALIDATORS:
+            # Sin plantilla (None) es una opción válida
+            if values[key] is not None and values[key] not in allowed:
+                raise ValueError(_ERR[key])
     for key, value in fields.items():
-        if len(str(value)) > MAX_FIELD_LENGTH:
-            raise ValueError(f'El campo {key} excede el límite de {MAX_FIELD_LENGTH} caracteres.')
+        CHECK_FIELD(str(value), key)
     return prompt, doc_type, template, fields, level, language, custom_file_name, logo_path
 
 @app.route('/')
 def index():
     if 'session_id' not in session:
-        session['session_id'] = os.urandom(16).hex()
+        session['session_id'] = g.session_id
     return render_template('index.html')
 
 @app.route('/get_history', methods=['GET'])
 def get_history_route():
-    session_id = session.get('session_id', os.urandom(16).hex())
+    session_id = g.session_id
     db = get_db()
     history = get_history(db, session_id)
     return jsonify({'history': history})
 
 @app.route('/clear_history', methods=['POST'])
 def clear_history_route():
-    session_id = session.get('session_id', os.urandom(16).hex())
+    session_id = g.session_id
     db = get_db()
     clear_history(db, session_id)
+    db.commit()
     generator.reset_context(session_id)
     logging.info("Historial y contexto de conversación limpiados")
     return jsonify({'status': 'success'})
 
 @app.route('/reset_context', methods=['POST'])
 def reset_context_route():
-    session_id = session.get('session_id', os.urandom(16).hex())
+    session_id = g.session_id
     generator.reset_context(session_id)
     logging.info(f"Contexto reiniciado para session_id: {session_id}")
     return jsonify({'status': 'success'})
@@ -126,6 +188,7 @@ def save_template_route():
             return jsonify({'error': 'Nombre o contenido de la plantilla vacío.'}), 400
         db = get_db()
         save_template(db, name, content)
+        db.commit()
         return jsonify({'status': 'success'})
     except Exception as e:
         logging.error(f"Error al guardar plantilla: {str(e)}")
@@ -142,30 +205,33 @@ def get_templates_route():
         return jsonify({'error': f'Error al obtener plantillas: {str(e)}'}), 500
 
 @app.route('/preview', methods=['POST'])
-def preview_document():
+async def preview_document():
     try:
         data = request.json
         text = data.get('text', '').strip()
         doc_type = data.get('doc_type', 'texto').lower()
         if not text:
             return jsonify({'error': 'El texto está vacío.'}), 400
-        if doc_type not in VALID_DOC_TYPES:
-            return jsonify({'error': f'Tipo de documento inválido: {", ".join(VALID_DOC_TYPES)}'}), 400
+        if not is_valid_doc_type(doc_type):
+            return jsonify({'error': _ERR['doc_type']}), 400
+
+        if doc_type in BACKGROUND_DOC_TYPES:
+            return jsonify({
+                'preview': RENDERING_MESSAGE,
+                'file_id': enqueue_render(text, doc_type, "es", "preview")
+            })
 
-        response, file_id, buffer, mime_type, file_name, preview_content = generator.render(
-            text, doc_type, "es", "preview"
+        # El renderizado es CPU; se hace en un hilo aparte para no bloquear el bucle
+        response, file_id, buffer, mime_type, file_name, preview_content = await asyncio.to_thread(
+            generator.render, text, doc_type, "es", "preview", want_preview=True
         )
 
         if file_id:
-            file_storage[file_id] = {
-                'buffer': buffer,
-                'file_name': file_name,
-                'mime_type': mime_type
-            }
+            stored = StoredFile(buffer, file_name, mime_type)
+            with file_storage_lock:
+                file_storage[file_id] = stored
 
-        preview_text = preview_content if preview_content else response
-        if doc_type == 'docx' and preview_text:
-            preview_text = preview_text.replace('\n\n', '\n').strip()
+        preview_text = preview_content or response
 
         return jsonify({
             'preview': preview_text,
@@ -179,16 +245,28 @@ def preview_document():
 @app.route('/download/<file_id>', methods=['GET'])
 def download_file(file_id):
     try:
-        if file_id not in file_storage:
+        with file_storage_lock:
+            stored = file_storage.get(file_id)
+        if stored is None:
             return jsonify({'error': 'Archivo no encontrado.'}), 404
-        file_info = file_storage[file_id]
-        buffer = file_info['buffer']
-        buffer.seek(0)
+        if isinstance(stored, Future):
+            if not stored.done():
+                return jsonify({'status': 'rendering'}), 202, {'Retry-After': '1'}
+            # Si el renderizado falló, result() relanza la excepción y se responde 500
+            content_id, stored = stored.result()
+            # Igual que en el renderizado en línea, el archivo queda bajo su id por contenido;
+            # el id de sondeo apunta a la misma entrada
+            with file_storage_lock:
+                if content_id:
+                    file_storage[content_id] = stored
+                file_storage[file_id] = stored
+        # conditional=True permite respuestas 304 y peticiones Range (visor PDF)
         return send_file(
-            buffer,
+            stored.open(),
             as_attachment=True,
-            download_name=file_info['file_name'],
-            mimetype=file_info['mime_type']
+            download_name=stored.file_name,
+            mimetype=stored.mime_type,
+            conditional=True
         )
     except Exception as e:
         logging.error(f"Error al descargar archivo con file_id {file_id}: {str(e)}")
@@ -202,47 +280,67 @@ def upload_logo():
         file = request.files['file']
         if file.filename == '':
             return jsonify({'error': 'Nombre de archivo vacío'}), 400
-        upload_dir = 'uploads'
-        os.makedirs(upload_dir, exist_ok=True)
-        file_path = os.path.join(upload_dir, file.filename)
-        file.save(file_path)
+        os.makedirs(UPLOAD_DIR, exist_ok=True)
+        ext = os.path.splitext(secure_filename(file.filename))[1].lower()
+        # Se copia por bloques a un temporal mientras se calcula el resumen del contenido
+        digest = blake2b(digest_size=16)
+        with tempfile.NamedTemporaryFile(dir=UPLOAD_DIR, delete=False) as tmp:
+            try:
+                while chunk := file.stream.read(UPLOAD_CHUNK_SIZE):
+                    digest.update(chunk)
+                    tmp.write(chunk)
+            except Exception:
+                os.unlink(tmp.name)
+                raise
+        # El nombre es el resumen: el mismo logotipo subido otra vez reutiliza el archivo existente
+        file_path = os.path.join(UPLOAD_DIR, f"{digest.hexdigest()}{ext}")
+        if os.path.exists(file_path):
+            os.unlink(tmp.name)
+        else:
+            os.replace(tmp.name, file_path)
         return jsonify({'path': file_path})
     except Exception as e:
         logging.error(f"Error al subir logotipo: {str(e)}")
         return jsonify({'error': f'Error al subir logotipo: {str(e)}'}), 500
 
 @app.route('/generate', methods=['POST'])
-def generate_document():
+async def generate_document():
     try:
         data = request.json
         if not data:
             raise ValueError("No se proporcionaron datos en la solicitud.")
         
         prompt, doc_type, template, fields, level, language, custom_file_name, logo_path = validate_input(data)
-        session_id = session.get('session_id', os.urandom(16).hex())
+        session_id = g.session_id
         db = get_db()
 
         if template in TEMPLATES:
-            required_fields = re.findall(r'\{(\w+)\}', TEMPLATES[template])
-            missing_fields = [f for f in required_fields if f not in fields or not fields[f]]
+            missing_fields = [f for f in REQUIRED_TEMPLATE_FIELDS[template] if not fields.get(f)]
             if missing_fields:
                 return jsonify({'error': f'Faltan campos: {", ".join(missing_fields)}'}), 400
 
-        history = get_history(db, session_id)
-        generated_text, is_conversational = generator.generate(prompt, doc_type, template, fields, level, language, history, session_id)
+        # sqlite y el renderizado van a hilos de trabajo; la llamada a OpenAI se espera sin bloquear
+        history = await asyncio.to_thread(get_history, db, session_id)
+        generated_text, is_conversational = await generator.run_async(
+            generator.generate(prompt, doc_type, template, fields, level, language, history, session_id)
+        )
 
         if not generated_text:
             raise ValueError("El texto generado está vacío.")
 
         if template in TEMPLATES and fields and not is_conversational:
             try:
-                generated_text = TEMPLATES[template].format(**fields, contenido=generated_text)
+                generated_text = TEMPLATE_RENDERERS[template]({**fields, GENERATED_FIELD: generated_text})
             except KeyError as e:
                 raise ValueError(f"Error al aplicar la plantilla: campo faltante {str(e)}")
 
-        save_history(db, session_id, 'user', prompt)
-        save_history(db, session_id, 'assistant', generated_text)
-        save_history(db, session_id, 'system', f"Documento generado: tipo={doc_type}, nivel={level}, idioma={language}")
+        now = datetime.now()
+        await asyncio.to_thread(save_history_batch, db, [
+            (session_id, 'user', prompt, now),
+            (session_id, 'assistant', generated_text, now),
+            (session_id, 'system', f"Documento generado: tipo={doc_type}, nivel={level}, idioma={language}", now),
+        ])
+        await asyncio.to_thread(db.commit)
 
         response_data = {
             'response': generated_text,
@@ -255,16 +353,22 @@ def generate_document():
             response_data['preview_content'] = preview_text
         else:
             file_name = custom_file_name if custom_file_name else generate_file_name(prompt, template, doc_type, level)
-            response, file_id, buffer, mime_type, full_file_name, preview_content = generator.render(
-                generated_text, doc_type, language, file_name, logo_path
+            if doc_type in BACKGROUND_DOC_TYPES:
+                response_data.update({
+                    'file_name': f"{file_name}.{doc_type}",
+                    'file_id': enqueue_render(generated_text, doc_type, language, file_name, logo_path),
+                    'preview_content': RENDERING_MESSAGE
+                })
+                return jsonify(response_data)
+
+            response, file_id, buffer, mime_type, full_file_name, preview_content = await asyncio.to_thread(
+                generator.render, generated_text, doc_type, language, file_name, logo_path, want_preview=True
             )
 
             if not response:
                 raise ValueError("La respuesta renderizada está vacía.")
 
-            preview_text = preview_content if preview_content else response
-            if doc_type == 'docx' and preview_text:
-                preview_text = preview_text.replace('\n\n', '\n').strip()
+            preview_text = preview_content or response
 
             response_data.update({
                 'file_name': full_file_name,
@@ -273,11 +377,9 @@ def generate_document():
             })
 
             if file_id:
-                file_storage[file_id] = {
-                    'buffer': buffer,
-                    'file_name': full_file_name,
-                    'mime_type': mime_type
-                }
+                stored = StoredFile(buffer, full_file_name, mime_type)
+                with file_storage_lock:
+                    file_storage[file_id] = stored
 
         return jsonify(response_data)
 
@@ -288,5 +390,62 @@ def generate_document():
         logging.error(f"Error inesperado en /generate: {str(e)}")
         return jsonify({'error': f'Error al generar el documento: {str(e)}'}), 500
 
+def _sse(data: dict, event: str = None) -> str:
+    prefix = f"event: {event}\n" if event else ""
+    return f"{prefix}data: {json.dumps(data)}\n\n"
+
+@app.route('/generate_stream', methods=['POST'])
+def generate_stream_route():
+    """Devuelve el texto como Server-Sent Events a medida que se genera; el renderizado de documentos sigue en /generate."""
+    try:
+        data = request.json
+        if not data:
+            raise ValueError("No se proporcionaron datos en la solicitud.")
+        prompt, doc_type, template, fields, level, language, _, _ = validate_input(data)
+        if template in TEMPLATES:
+            missing_fields = [f for f in REQUIRED_TEMPLATE_FIELDS[template] if not fields.get(f)]
+            if missing_fields:
+                return jsonify({'error': f'Faltan campos: {", ".join(missing_fields)}'}), 400
+    except ValueError as e:
+        logging.error(f"Error de validación en /generate_stream: {str(e)}")
+        return jsonify({'error': f'Error de validación: {str(e)}'}), 400
+
+    session_id = g.session_id
+    db = get_db()
+    history = get_history(db, session_id)
+    is_conversational = generator.is_conversational_prompt(prompt)
+
+    def _sse_gen():
+        parts = []
+        try:
+            for delta in generator.iter_sync(generator.generate_stream(prompt, doc_type, template, level, language, history, session_id)):
+                parts.append(delta)
+                yield _sse({'delta': delta})
+
+            # La plantilla y el historial se aplican al cerrarse el stream, con el texto completo
+            generated_text = "".join(parts).strip()
+            if not generated_text:
+                raise ValueError("El texto generado está vacío.")
+            if template in TEMPLATES and fields and not is_conversational:
+                generated_text = TEMPLATE_RENDERERS[template]({**fields, GENERATED_FIELD: generated_text})
+            now = datetime.now()
+            save_history_batch(db, [
+                (session_id, 'user', prompt, now),
+                (session_id, 'assistant', generated_text, now),
+                (session_id, 'system', f"Documento generado en streaming: tipo={doc_type}, nivel={level}, idioma={language}", now),
+            ])
+            db.commit()
+            yield _sse({'response': generated_text, 'is_document': not is_conversational}, event='done')
+        except Exception as e:
+            logging.error(f"Error en /generate_stream: {str(e)}")
+            yield _sse({'error': f'Error al generar el texto: {str(e)}'}, event='error')
+
+    return Response(
+        stream_with_context(_sse_gen()),
+        mimetype='text/event-stream',
+        # Sin caché ni buffer en proxies para que cada fragmento llegue en cuanto se emite
+        headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'}
+    )
+
 if __name__ == '__main__':
     app.run(debug=True)
\ No newline at end of file
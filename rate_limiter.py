@@ -0,0 +1,47 @@
+# rate_limiter.py
+import asyncio
+import time
+
+class RateLimiter:
+    """Cubo de fichas para los límites de OpenAI: peticiones por minuto (RPM) y tokens por minuto (TPM).
+
+    Las fichas se recargan de forma continua según el tiempo transcurrido; acquire() espera
+    hasta que haya capacidad para la petición, de modo que las llamadas concurrentes se
+    mantienen justo por debajo del límite en lugar de provocar errores 429.
+    """
+
+    def __init__(self, max_requests_per_minute: int, max_tokens_per_minute: int):
+        self.max_requests = max_requests_per_minute
+        self.max_tokens = max_tokens_per_minute
+        self.available_requests = float(max_requests_per_minute)
+        self.available_tokens = float(max_tokens_per_minute)
+        self.last_update = time.monotonic()
+        # Se crea en el primer acquire para quedar ligado al bucle que lo usa
+        self._lock = None
+
+    def _refill(self) -> None:
+        now = time.monotonic()
+        elapsed = now - self.last_update
+        self.last_update = now
+        self.available_requests = min(self.max_requests, self.available_requests + elapsed * self.max_requests / 60)
+        self.available_tokens = min(self.max_tokens, self.available_tokens + elapsed * self.max_tokens / 60)
+
+    async def acquire(self, tokens: int) -> None:
+        """Reserva una petición y `tokens` tokens, esperando lo necesario."""
+        # Una petición mayor que el cubo completo nunca cabría: se limita al máximo
+        tokens = min(tokens, self.max_tokens)
+        if self._lock is None:
+            self._lock = asyncio.Lock()
+        # El candado mantiene el orden de llegada mientras se espera la recarga
+        async with self._lock:
+            while True:
+                self._refill()
+                if self.available_requests >= 1 and self.available_tokens >= tokens:
+                    self.available_requests -= 1
+                    self.available_tokens -= tokens
+                    return
+                wait = max(
+                    (1 - self.available_requests) * 60 / self.max_requests,
+                    (tokens - self.available_tokens) * 60 / self.max_tokens,
+                )
+                await asyncio.sleep(wait)
@@ -0,0 +1,41 @@
+# response_cache.py
+import logging
+from hashlib import sha256
+from cachetools import TTLCache
+import redis.asyncio as aioredis
+
+class ResponseCache:
+    """Caché de respuestas en dos niveles: L1 en memoria del proceso y L2 en Redis, compartida entre workers."""
+
+    def __init__(self, redis_url: str = None, maxsize: int = 100, ttl: int = 3600):
+        self.l1 = TTLCache(maxsize=maxsize, ttl=ttl)
+        self.ttl = ttl
+        # Sin REDIS_URL se trabaja solo con la caché local
+        self.l2 = aioredis.from_url(redis_url, decode_responses=True) if redis_url else None
+
+    @staticmethod
+    def _redis_key(key: str) -> str:
+        return f"respuesta:{sha256(key.encode()).hexdigest()}"
+
+    async def get(self, key: str):
+        if key in self.l1:
+            return self.l1[key]
+        if self.l2 is None:
+            return None
+        try:
+            value = await self.l2.get(self._redis_key(key))
+        except Exception as e:
+            logging.error(f"Error al leer la caché de Redis: {str(e)}")
+            return None
+        if value is not None:
+            self.l1[key] = value
+        return value
+
+    async def set(self, key: str, value: str) -> None:
+        self.l1[key] = value
+        if self.l2 is None:
+            return
+        try:
+            await self.l2.set(self._redis_key(key), value, ex=self.ttl)
+        except Exception as e:
+            logging.error(f"Error al escribir en la caché de Redis: {str(e)}")
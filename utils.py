@@ -1,456 +1,468 @@
 import re
 import json
 from datetime import datetime
-from hashlib import sha256
+from hashlib import blake2b, sha256
 from html import escape
 import io
 import uuid
-import matplotlib.pyplot as plt
-from reportlab.lib.pagesizes import letter
-from reportlab.platypus import SimpleDocTemplate, Paragraph, Spacer, Table, Image
-from reportlab.lib.styles import getSampleStyleSheet, ParagraphStyle
-from reportlab.lib import colors
-from reportlab.lib.units import inch
-from reportlab.lib.enums import TA_JUSTIFY
-from reportlab.platypus import KeepTogether
-from docx import Document
-from docx.shared import Pt, Inches, RGBColor
-from docx.enum.text import WD_ALIGN_PARAGRAPH
-from docx.oxml.ns import qn
-from docx.oxml import OxmlElement
+# reportlab se importa dentro de las funciones que lo usan, para que los procesos que
+# solo generan texto no lo carguen
 from deep_translator import GoogleTranslator
 import os
+import atexit
 import logging
-
-logging.basicConfig(level=logging.INFO, filename='app.log', format='%(asctime)s - %(levelname)s - %(message)s')
+import queue
+import threading
+from functools import lru_cache
+from cachetools import LRUCache, TTLCache, cached
+from logging.handlers import QueueHandler, QueueListener
+from history_manager import acquire_connection, release_connection, get_translation, save_translation
+
+_log_listener = None
+
+# Expresiones usadas en cada petición o en cada línea, compiladas una sola vez
+_WORD_RE = re.compile(r'\b\w+\b')
+_PUNCT_RE = re.compile(r'[^\w\s]')
+_SPACES_RE = re.compile(r'\s+')
+# Directiva de gráfico ("Gráfico de barras con datos: A: 1, B: 2") y sus pares etiqueta: valor
+_CHART_RE = re.compile(r'gráfico de (barras|líneas) con datos:\s*(.+)$', re.IGNORECASE)
+_PAIR_RE = re.compile(r'([^,:]+):\s*(-?[\d.]+)')
+_CHART_TYPES = {'barras': 'bar', 'líneas': 'line'}
+
+# Estilo de cada nivel de encabezado markdown (índice = número de '#')
+_PDF_HEADING_STYLES = (None, 'Heading1', 'Heading2', 'Heading3')
+
+@lru_cache(maxsize=1)
+def _pdf_table_style() -> list:
+    """Estilo común de las tablas del PDF; reportlab lo copia en cada Table, así que se comparte."""
+    from reportlab.lib import colors
+    return [
+        ('GRID', (0, 0), (-1, -1), 1, colors.grey),
+        ('BACKGROUND', (0, 0), (-1, 0), colors.HexColor("#f0f4f0")),
+        ('FONTNAME', (0, 0), (-1, 0), 'Helvetica-Bold'),
+        ('FONTSIZE', (0, 0), (-1, -1), 10),
+        ('VALIGN', (0, 0), (-1, -1), 'MIDDLE'),
+    ]
+
+def _heading_depth(line: str) -> int:
+    """Nivel del encabezado ('# ' a '### ') o 0 si la línea no lo es."""
+    depth = len(line) - len(line.lstrip('#'))
+    return depth if depth <= 3 and line[depth:depth + 1] == ' ' else 0
+
+def configure_logging(filename: str = 'app.log') -> None:
+    """Envía los registros a una cola; un hilo aparte los escribe en `filename`."""
+    global _log_listener
+    if _log_listener is not None:
+        return
+    file_handler = logging.FileHandler(filename)
+    file_handler.setFormatter(logging.Formatter('%(asctime)s - %(levelname)s - %(message)s'))
+    log_queue = queue.SimpleQueue()
+    root = logging.getLogger()
+    root.setLevel(logging.INFO)
+    root.addHandler(QueueHandler(log_queue))
+    _log_listener = QueueListener(log_queue, file_handler)
+    _log_listener.start()
+    # Vacía la cola antes de salir
+    atexit.register(_log_listener.stop)
+
+configure_logging()
 
 def generate_file_name(prompt: str, template: str, doc_type: str, level: str) -> str:
-    words = [w for w in re.findall(r'\b\w+\b', prompt.lower()) if len(w) > 3][:3]
+    words = [w for w in _WORD_RE.findall(prompt.lower()) if len(w) > 3][:3]
     base_name = '_'.join(words) if words else 'documento'
     timestamp = datetime.now().strftime('%Y%m%d_%H%M%S')
     return f"{base_name}_{template or doc_type}_{level}_{timestamp}"
 
-def generate_cache_key(prompt: str, doc_type: str, template: str, fields: dict, level: str, history: list) -> str:
-    history_str = json.dumps(history, sort_keys=True)
-    return f"{prompt}:{doc_type}:{template}:{json.dumps(fields, sort_keys=True)}:{level}:{sha256(history_str.encode()).hexdigest()}"
+# Verbos que indican que el usuario quiere modificar el documento anterior
+MODIFICATION_KEYWORDS = ('añade', 'agrega', 'modifica', 'cambia', 'elimina', 'quita', 'corrige', 'actualiza', 'reescribe')
+
+def normalize_prompt(prompt: str) -> str:
+    """Pasa a minúsculas, quita la puntuación y colapsa los espacios del prompt."""
+    return _SPACES_RE.sub(' ', _PUNCT_RE.sub('', prompt.lower())).strip()
+
+def generate_cache_key(prompt: str, doc_type: str, template: str, level: str, language: str,
+                       history: list = None, model: str = 'gpt-4o') -> str:
+    normalized = normalize_prompt(prompt)
+    key = f"{model}:{template}:{level}:{language}:{doc_type}:{normalized}"
+    # El historial solo identifica la respuesta cuando se pide modificar el documento anterior;
+    # se serializa como pares (rol, contenido), sin ordenar claves, y se resume con BLAKE2b
+    if history and any(word in normalized for word in MODIFICATION_KEYWORDS):
+        history_json = json.dumps([(message['role'], message['content']) for message in history])
+        key += f":{blake2b(history_json.encode(), digest_size=16).hexdigest()}"
+    return blake2b(key.encode(), digest_size=16).hexdigest()
+
+# Caracteres que html.escape sustituye (quote=True)
+_HTML_UNSAFE = frozenset('&<>"\'')
 
 def sanitize_fields(fields: dict) -> dict:
-    return {key: escape(str(value)) for key, value in fields.items()}
+    sanitized = {}
+    for key, value in fields.items():
+        # Se sigue devolviendo str (0 no debe contar como campo vacío); solo se escapa si hace falta
+        text = value if type(value) is str else str(value)
+        sanitized[key] = text if _HTML_UNSAFE.isdisjoint(text) else escape(text)
+    return sanitized
+
+# Prefijo de cada rol en el resumen del historial; los demás roles (system) se omiten
+_SUMMARY_PREFIXES = {'user': "- El usuario dijo: ", 'assistant': "- La IA respondió: "}
 
 def summarize_history(history: list) -> str:
     if not history:
         return ""
-    summary = "Contexto previo de la conversación:\n"
+    parts = ["Contexto previo de la conversación:\n"]
     for message in history:
-        if message['role'] == 'user':
-            summary += f"- El usuario dijo: {message['content'][:100]}...\n"
-        elif message['role'] == 'assistant':
-            summary += f"- La IA respondió: {message['content'][:100]}...\n"
-    return summary
+        prefix = _SUMMARY_PREFIXES.get(message['role'])
+        if prefix is not None:
+            parts.append(f"{prefix}{message['content'][:100]}...\n")
+    return "".join(parts)
+
+# GoogleTranslator.translate() reescribe sus parámetros de petición en cada llamada, así
+# que una instancia no se puede compartir entre hilos: cada hilo guarda las suyas
+_translators = threading.local()
+
+def _get_translator(target_lang: str) -> GoogleTranslator:
+    """Un traductor por hilo e idioma de destino, creado la primera vez que se necesita."""
+    cache = _translators.__dict__.setdefault('by_lang', {})
+    translator = cache.get(target_lang)
+    if translator is None:
+        translator = cache[target_lang] = GoogleTranslator(source='es', target=target_lang)
+    return translator
+
+def _translate_uncached(text: str, target_lang: str) -> str:
+    translated = _get_translator(target_lang).translate(text)
+    if not translated:
+        raise ValueError("traducción vacía")
+    return translated
+
+def _translation_key(text: str, target_lang: str) -> str:
+    return sha256(f"{target_lang}\0{text}".encode()).hexdigest()
+
+@lru_cache(maxsize=4096)
+def _cached_translation(text: str, target_lang: str) -> str:
+    """Traducción en memoria, luego en la tabla `translations` y solo si falta, por red.
+
+    Los fallos lanzan excepción, así que ni lru_cache ni la tabla guardan el texto sin traducir.
+    """
+    key = _translation_key(text, target_lang)
+    db = acquire_connection()
+    try:
+        translated = get_translation(db, key)
+    finally:
+        release_connection(db)
+    if translated is not None:
+        return translated
+    # La conexión no se retiene durante la petición HTTPS
+    translated = _translate_uncached(text, target_lang)
+    db = acquire_connection()
+    try:
+        save_translation(db, key, translated)
+        db.commit()
+    finally:
+        release_connection(db)
+    return translated
+
+# Idiomas de destino que no requieren traducción (el texto de origen ya está en español)
+_NO_TRANSLATION = frozenset({'es', '', None})
+
+def _needs_translation(text: str, target_lang: str) -> bool:
+    """Descarta sin red los textos vacíos, sin letras (números, signos) o ya en el idioma de destino."""
+    return target_lang not in _NO_TRANSLATION and any(c.isalpha() for c in text)
 
 def translate_text(text: str, target_lang: str) -> str:
-    if target_lang == 'es':
+    if not _needs_translation(text, target_lang):
         return text
     try:
-        translated = GoogleTranslator(source='es', target=target_lang).translate(text)
-        if not translated:
-            logging.warning(f"Traducción vacía para el texto '{text}' a {target_lang}, retornando texto original.")
-            return text
-        return translated
+        return _cached_translation(text, target_lang)
     except Exception as e:
         logging.error(f"Error al traducir texto '{text}' a {target_lang}: {str(e)}")
         return text
 
-def generate_chart(data: dict, chart_type: str) -> io.BytesIO:
-    buffer = io.BytesIO()
+def translate_batch(texts: list, target_lang: str) -> list:
+    """Traduce varias cadenas (de una línea) con una sola petición; devuelve la lista en el mismo orden.
+
+    GoogleTranslator.translate_batch hace una petición por cadena, así que las que no están
+    en la tabla `translations` se envían juntas separadas por saltos de línea. Si la respuesta
+    no trae una línea por cadena, se traducen una a una.
+    """
+    if target_lang in _NO_TRANSLATION:
+        return list(texts)
+    keys = {text: _translation_key(text, target_lang) for text in texts if _needs_translation(text, target_lang)}
+    if not keys:
+        return list(texts)
+    db = acquire_connection()
     try:
-        labels = list(data.keys())
-        values = list(data.values())
-        if not labels or not values:
-            raise ValueError("Datos de gráfico vacíos o inválidos")
-
-        values = [float(v) for v in values]
-        
-        plt.figure(figsize=(6, 4))
+        found = {text: get_translation(db, key) for text, key in keys.items()}
+    finally:
+        release_connection(db)
+    missing = [text for text, value in found.items() if value is None]
+    if missing:
+        try:
+            translated = _translate_uncached("\n".join(missing), target_lang).split("\n")
+            if len(translated) != len(missing):
+                raise ValueError("la traducción conjunta no conserva las líneas")
+            translated = [line.strip() or text for text, line in zip(missing, translated)]
+            db = acquire_connection()
+            try:
+                for text, value in zip(missing, translated):
+                    save_translation(db, keys[text], value)
+                db.commit()
+            finally:
+                release_connection(db)
+        except Exception as e:
+            logging.warning(f"Traducción conjunta a {target_lang} fallida, se traduce por separado: {str(e)}")
+            translated = [translate_text(text, target_lang) for text in missing]
+        found.update(zip(missing, translated))
+    return [found.get(text, text) for text in texts]
+
+# Textos fijos de los documentos (encabezado, pie, índice); no dependen de la petición
+_UI_STRINGS = {
+    'header': "Documento Generado Automáticamente - IA Generador",
+    'page': "Página",
+    'toc': "Índice",
+}
+# Traducciones ya resueltas por idioma; cada documento solo consulta este diccionario
+_UI_TRANSLATIONS = {'es': _UI_STRINGS}
+
+def _ui_strings(language: str) -> dict:
+    """Textos fijos traducidos a `language`; se traducen la primera vez que se pide el idioma."""
+    strings = _UI_TRANSLATIONS.get(language)
+    if strings is None:
+        strings = dict(zip(_UI_STRINGS, translate_batch(list(_UI_STRINGS.values()), language)))
+        # En los idiomas admitidos ningún texto coincide con el original: si alguno coincide es
+        # que su traducción falló y se reintentará en el siguiente documento
+        if all(strings[name] != text for name, text in _UI_STRINGS.items()):
+            _UI_TRANSLATIONS[language] = strings
+    return strings
+
+_CHART_LOCK = threading.Lock()
+
+@lru_cache(maxsize=1)
+def _chart_axes():
+    """Figura única reutilizada para los PNG del DOCX; matplotlib solo se importa si hace falta.
+
+    Figure no pasa por pyplot, así que no queda registrada ni hay que cerrarla.
+    """
+    import matplotlib
+    matplotlib.use('Agg')  # Sin pantalla: solo se renderiza a PNG
+    from matplotlib.figure import Figure
+    figure = Figure(figsize=(6, 4))
+    return figure, figure.add_subplot()
+
+# PNG ya renderizados por (tipo, datos, tamaño); el orden de los pares se conserva porque es el del eje
+@cached(cache=LRUCache(maxsize=128),
+        key=lambda data, chart_type, dpi, figsize: (chart_type, tuple(data.items()), dpi, figsize),
+        lock=threading.Lock())
+def _chart_png(data: dict, chart_type: str, dpi: int, figsize: tuple) -> bytes:
+    labels = list(data.keys())
+    values = list(data.values())
+    if not labels or not values:
+        raise ValueError("Datos de gráfico vacíos o inválidos")
+
+    values = [float(v) for v in values]
+
+    buffer = io.BytesIO()
+    # La figura es compartida: se dibuja de uno en uno desde los hilos de renderizado
+    with _CHART_LOCK:
+        fig, ax = _chart_axes()
+        fig.set_size_inches(figsize)
+        ax.clear()
         if chart_type == "bar":
-            plt.bar(labels, values, color='skyblue')
+            ax.bar(labels, values, color='skyblue')
         elif chart_type == "line":
-            plt.plot(labels, values, marker='o', color='skyblue')
-        plt.xlabel("Categorías")
-        plt.ylabel("Valores")
-        plt.title("Gráfico Generado")
-        plt.grid(True)
-        plt.savefig(buffer, format='png', bbox_inches='tight', dpi=100)
-        plt.close()
-        buffer.seek(0)
-        return buffer
+            ax.plot(labels, values, marker='o', color='skyblue')
+        ax.set_xlabel("Categorías")
+        ax.set_ylabel("Valores")
+        ax.set_title("Gráfico Generado")
+        ax.grid(True)
+        fig.savefig(buffer, format='png', bbox_inches='tight', dpi=dpi, pil_kwargs={'optimize': True})
+    return buffer.getvalue()
+
+def generate_chart(data: dict, chart_type: str, dpi: int = 100, figsize: tuple = (6, 4)) -> io.BytesIO:
+    try:
+        return io.BytesIO(_chart_png(data, chart_type, dpi, tuple(figsize)))
     except Exception as e:
+        # Los errores no se guardan en caché; se devuelve un buffer vacío como antes
+        logging.error(f"Error al generar gráfico: {str(e)}")
+        return io.BytesIO()
+
+def parse_chart_line(line: str):
+    """Devuelve (tipo, datos) si la línea es una directiva de gráfico, o None si no lo es."""
+    match = _CHART_RE.search(line)
+    if match is None:
+        return None
+    chart_type = _CHART_TYPES[match.group(1).lower()]
+    try:
+        chart_data = {label.strip(): float(value) for label, value in _PAIR_RE.findall(match.group(2))}
+    except ValueError as e:
+        logging.error(f"Error al procesar datos de gráfico: {str(e)}")
+        return chart_type, None
+    return chart_type, chart_data or None
+
+_CHART_COLOR = "#87ceeb"  # skyblue, el mismo color que en los PNG
+
+def generate_chart_flowable(data: dict, chart_type: str, width: int = 400, height: int = 300):
+    """Gráfico vectorial de reportlab para insertar directamente en el PDF; None si los datos no sirven."""
+    from reportlab.lib import colors
+    from reportlab.graphics.shapes import Drawing, String
+    from reportlab.graphics.charts.barcharts import VerticalBarChart
+    from reportlab.graphics.charts.linecharts import HorizontalLineChart
+    from reportlab.graphics.widgets.markers import makeMarker
+    try:
+        values = [float(v) for v in data.values()]
+    except (TypeError, ValueError) as e:
         logging.error(f"Error al generar gráfico: {str(e)}")
-        buffer.seek(0)
-        return buffer
+        return None
+    if not values:
+        logging.error("Error al generar gráfico: Datos de gráfico vacíos o inválidos")
+        return None
+
+    chart = VerticalBarChart() if chart_type == "bar" else HorizontalLineChart()
+    chart.x, chart.y = 50, 45
+    chart.width, chart.height = width - 70, height - 90
+    chart.data = [values]
+    chart.categoryAxis.categoryNames = [str(label) for label in data]
+    chart.valueAxis.valueMin = min(0, min(values))
+    chart.valueAxis.visibleGrid = True
+    chart.valueAxis.gridStrokeColor = colors.lightgrey
+    if chart_type == "bar":
+        chart.bars[0].fillColor = colors.HexColor(_CHART_COLOR)
+    else:
+        chart.lines[0].strokeColor = colors.HexColor(_CHART_COLOR)
+        chart.lines[0].symbol = makeMarker('FilledCircle')
+
+    drawing = Drawing(width, height)
+    drawing.add(chart)
+    drawing.add(String(width / 2, height - 20, "Gráfico Generado", textAnchor='middle', fontName='Helvetica-Bold', fontSize=12))
+    drawing.add(String(width / 2, 8, "Categorías", textAnchor='middle', fontName='Helvetica', fontSize=9))
+    drawing.add(String(12, height / 2, "Valores", textAnchor='middle', fontName='Helvetica', fontSize=9))
+    return drawing
+
+# Resultado de comprobar el logotipo en disco; el TTL evita arrastrar un resultado obsoleto
+@cached(cache=TTLCache(maxsize=32, ttl=300), lock=threading.Lock())
+def logo_ok(logo_path: str) -> bool:
+    return bool(logo_path) and os.path.exists(logo_path)
 
 def add_logo_to_pdf(story: list, logo_path: str = None) -> None:
-    if logo_path and os.path.exists(logo_path):
+    if logo_ok(logo_path):
+        from reportlab.platypus import Image, Spacer
         try:
             story.append(Image(logo_path, width=100, height=50))
             story.append(Spacer(1, 20))
         except Exception as e:
             logging.error(f"Error al añadir logotipo al PDF: {str(e)}")
 
-def add_logo_to_docx(doc: Document, logo_path: str = None) -> None:
-    if logo_path and os.path.exists(logo_path):
-        try:
-            doc.add_picture(logo_path, width=Inches(1.5))
-            last_paragraph = doc.paragraphs[-1]
-            last_paragraph.alignment = WD_ALIGN_PARAGRAPH.CENTER
-            doc.add_paragraph('')
-        except Exception as e:
-            logging.error(f"Error al añadir logotipo al DOCX: {str(e)}")
-
-def add_toc_to_docx(doc: Document, language: str) -> None:
-    try:
-        toc_title = translate_text("Índice", language)
-        paragraph = doc.add_paragraph(toc_title, style='CustomTitle')
-        
-        run = paragraph.add_run()
-        fldChar = OxmlElement('w:fldChar')
-        fldChar.set(qn('w:fldCharType'), 'begin')
-        run._element.append(fldChar)
-        
-        instrText = OxmlElement('w:instrText')
-        instrText.text = 'TOC \\o "1-3" \\h \\z \\u'
-        run._element.append(instrText)
-        
-        fldChar = OxmlElement('w:fldChar')
-        fldChar.set(qn('w:fldCharType'), 'end')
-        run._element.append(fldChar)
-        doc.add_paragraph('')
-    except Exception as e:
-        logging.error(f"Error al añadir tabla de contenidos al DOCX: {str(e)}")
+def _configure_pdf_styles(styles) -> None:
+    """Ajusta la hoja de estilos del PDF; se aplica una sola vez (ver _pdf_styles)."""
+    from reportlab.lib import colors
+    from reportlab.lib.enums import TA_JUSTIFY
+    for name, size, leading, space_after, color in (
+        ('Heading1', 16, 20, 12, "#1a3c34"),
+        ('Heading2', 14, 18, 10, "#2e5e54"),
+        ('Heading3', 12, 16, 8, "#437f74"),
+    ):
+        style = styles[name]
+        style.fontName = 'Helvetica-Bold'
+        style.fontSize = size
+        style.leading = leading
+        style.spaceAfter = space_after
+        style.textColor = colors.HexColor(color)
+    styles['BodyText'].fontName = 'Helvetica'
+    styles['BodyText'].fontSize = 11
+    styles['BodyText'].leading = 14
+    styles['BodyText'].alignment = TA_JUSTIFY  # Justificar el texto
 
-def parse_markdown_for_pdf(text: str, styles: dict, language: str, logo_path: str = None) -> list:
+@lru_cache(maxsize=1)
+def _pdf_styles():
+    """Hoja de estilos compartida por todos los PDF; se crea en el primer PDF y no se modifica después."""
+    from reportlab.lib.styles import getSampleStyleSheet
+    styles = getSampleStyleSheet()
+    _configure_pdf_styles(styles)
+    return styles
+
+def parse_markdown_for_pdf(text: str, language: str, logo_path: str = None, styles=None) -> list:
+    from reportlab.platypus import Paragraph, Spacer, Table
+    if styles is None:
+        styles = _pdf_styles()
     story = []
-    toc = []
-    toc_links = []
-    lines = text.split('\n')
+    section_count = 0  # Anclas del índice numeradas por encabezado, no por línea
     in_list = False
-    list_level = 0
     table_data = []
     chart_data = None
     chart_type = None
 
-    # Estilos personalizados para PDF
-    styles['Heading1'].textColor = colors.HexColor("#1a3c34")
-    styles['Heading1'].fontSize = 16
-    styles['Heading1'].spaceAfter = 12
-    styles['Heading2'].textColor = colors.HexColor("#2e5e54")
-    styles['Heading2'].fontSize = 14
-    styles['Heading2'].spaceAfter = 10
-    styles['Heading3'].textColor = colors.HexColor("#437f74")
-    styles['Heading3'].fontSize = 12
-    styles['Heading3'].spaceAfter = 8
-    styles['BodyText'].fontName = 'Helvetica'
-    styles['BodyText'].fontSize = 11
-    styles['BodyText'].leading = 14
-    styles['BodyText'].alignment = TA_JUSTIFY  # Justificar el texto
+    ui = _ui_strings(language)
+    header_text, page_label, toc_title = ui['header'], ui['page'], ui['toc']
+    # El índice se construye aparte, en orden, y se antepone al final en una sola operación
+    toc_flowables = [Paragraph(toc_title, styles['Heading1'])]
 
     def add_header_footer(canvas, doc):
         canvas.saveState()
         canvas.setFont('Helvetica', 8)
-        header_text = translate_text("Documento Generado Automáticamente - IA Generador", language)
-        footer_text = translate_text(f"Página {canvas.getPageNumber()}", language)
         canvas.drawString(72, 770, header_text)
-        canvas.drawRightString(500, 50, footer_text)
+        canvas.drawRightString(500, 50, f"{page_label} {canvas.getPageNumber()}")
         canvas.restoreState()
 
-    add_logo_to_pdf(story, logo_path)
+    def _flush_table():
+        story.append(Table(table_data, colWidths=[100] * len(table_data[0]), style=_pdf_table_style()))
+        table_data.clear()
 
-    # Detectar gráficos
-    for line in lines:
-        line = line.strip()
-        if "gráfico de barras con datos:" in line.lower():
-            chart_type = "bar"
-            data_str = line.split("con datos:")[1].strip()
-            data_pairs = data_str.split(",")
-            try:
-                chart_data = {pair.split(":")[0].strip(): float(pair.split(":")[1].strip()) for pair in data_pairs}
-            except Exception as e:
-                logging.error(f"Error al procesar datos de gráfico: {str(e)}")
-                chart_data = None
-            continue
-        elif "gráfico de líneas con datos:" in line.lower():
-            chart_type = "line"
-            data_str = line.split("con datos:")[1].strip()
-            data_pairs = data_str.split(",")
-            try:
-                chart_data = {pair.split(":")[0].strip(): float(pair.split(":")[1].strip()) for pair in data_pairs}
-            except Exception as e:
-                logging.error(f"Error al procesar datos de gráfico: {str(e)}")
-                chart_data = None
-            continue
+    add_logo_to_pdf(story, logo_path)
 
-    # Parsear el contenido
-    for i, line in enumerate(lines):
-        line = line.strip()
+    # Parsear el contenido en una sola pasada; las directivas de gráfico se recogen al vuelo
+    # y el último gráfico encontrado se añade al final, como antes
+    for raw in text.splitlines():
+        # La línea original conserva la sangría (nivel de lista); el resto de comprobaciones usa la limpia
+        line = raw.strip()
         if not line:
             story.append(Spacer(1, 12))
             continue
-        if line.startswith('# '):
-            toc.append((line[2:], len(story), f"section_{i}"))
-            story.append(Paragraph(f'<a name="section_{i}"/>', styles['BodyText']))
-            story.append(Paragraph(line[2:], styles['Heading1']))
-            in_list = False
-        elif line.startswith('## '):
-            toc.append((line[3:], len(story), f"section_{i}"))
-            story.append(Paragraph(f'<a name="section_{i}"/>', styles['BodyText']))
-            story.append(Paragraph(line[3:], styles['Heading2']))
-            in_list = False
-        elif line.startswith('### '):
-            toc.append((line[4:], len(story), f"section_{i}"))
-            story.append(Paragraph(f'<a name="section_{i}"/>', styles['BodyText']))
-            story.append(Paragraph(line[4:], styles['Heading3']))
+        chart = parse_chart_line(line)
+        if chart is not None:
+            chart_type, chart_data = chart
+            continue
+        # Se despacha por el primer carácter en lugar de probar cada prefijo
+        c0 = line[0]
+        depth = _heading_depth(line) if c0 == '#' else 0
+        if depth:
+            title = line[depth + 1:]
+            anchor = f"section_{section_count}"
+            section_count += 1
+            toc_flowables.append(Paragraph(f'<link href="#{anchor}" color="blue">{title}</link>', styles['BodyText']))
+            story.append(Paragraph(f'<a name="{anchor}"/>', styles['BodyText']))
+            story.append(Paragraph(title, styles[_PDF_HEADING_STYLES[depth]]))
             in_list = False
-        elif line.startswith('- ') or line.startswith('* '):
-            indent = '  ' * list_level
-            story.append(Paragraph(f"{indent}• {line[2:]}", styles['BodyText']))
-            in_list = True
-        elif line.startswith('  - ') or line.startswith('  * '):
-            list_level = 1
-            story.append(Paragraph(f"  ◦ {line[4:]}", styles['BodyText']))
+        elif (c0 == '-' or c0 == '*') and line.startswith(('- ', '* ')):
+            list_level = (len(raw) - len(raw.lstrip())) // 2
+            marker = '•' if list_level == 0 else '◦'
+            story.append(Paragraph(f"{'  ' * list_level}{marker} {line[2:]}", styles['BodyText']))
             in_list = True
-        elif line.startswith('|'):
+        elif c0 == '|':
             cells = [cell.strip() for cell in line.split('|')[1:-1]]
             if cells and all(cells):
                 table_data.append(cells)
         else:
             if table_data:
-                col_widths = [100] * len(table_data[0]) if table_data else [100]
-                story.append(Table(table_data, colWidths=col_widths, style=[
-                    ('GRID', (0, 0), (-1, -1), 1, colors.grey),
-                    ('BACKGROUND', (0, 0), (-1, 0), colors.HexColor("#f0f4f0")),
-                    ('FONTNAME', (0, 0), (-1, 0), 'Helvetica-Bold'),
-                    ('FONTSIZE', (0, 0), (-1, -1), 10),
-                    ('VALIGN', (0, 0), (-1, -1), 'MIDDLE'),
-                ]))
-                table_data = []
+                _flush_table()
             if in_list:
                 in_list = False
-                list_level = 0
                 story.append(Spacer(1, 12))
             story.append(Paragraph(line, styles['BodyText']))
 
     # Añadir tabla pendiente
     if table_data:
-        col_widths = [100] * len(table_data[0]) if table_data else [100]
-        story.append(Table(table_data, colWidths=col_widths, style=[
-            ('GRID', (0, 0), (-1, -1), 1, colors.grey),
-            ('BACKGROUND', (0, 0), (-1, 0), colors.HexColor("#f0f4f0")),
-            ('FONTNAME', (0, 0), (-1, 0), 'Helvetica-Bold'),
-            ('FONTSIZE', (0, 0), (-1, -1), 10),
-            ('VALIGN', (0, 0), (-1, -1), 'MIDDLE'),
-        ]))
-
-    # Añadir gráfico si existe
+        _flush_table()
+
+    # Añadir gráfico si existe (vectorial; matplotlib queda solo para el DOCX)
     if chart_data:
         try:
-            chart_buffer = generate_chart(chart_data, chart_type)
-            if chart_buffer.getvalue():
-                story.append(Image(chart_buffer, width=400, height=300))
+            chart = generate_chart_flowable(chart_data, chart_type)
+            if chart is not None:
+                story.append(chart)
                 story.append(Spacer(1, 20))
             else:
-                logging.warning("Buffer de gráfico vacío, no se añadió al PDF")
+                logging.warning("Gráfico vacío, no se añadió al PDF")
         except Exception as e:
             logging.error(f"Error al añadir gráfico al PDF: {str(e)}")
 
     # Añadir índice al inicio
-    toc_title = translate_text("Índice", language)
-    story.insert(0, Paragraph(toc_title, styles['Heading1']))
-    for title, pos, anchor in toc:
-        link = f'<link href="#{anchor}" color="blue">{title}</link>'
-        story.insert(1, Paragraph(link, styles['BodyText']))
-    story.insert(len(toc) + 1, Spacer(1, 20))
-
-    return story
-
-def parse_markdown_for_docx(doc: Document, text: str, language: str, logo_path: str = None) -> None:
-    try:
-        # Verificar que el texto no esté vacío
-        if not text:
-            raise ValueError("El texto proporcionado está vacío.")
-
-        # Estilos personalizados para DOCX
-        styles = doc.styles
-
-        # Estilo para Título (Índice)
-        if 'CustomTitle' not in styles:
-            title_style = styles.add_style('CustomTitle', 1)
-            title_style.font.name = 'Calibri'
-            title_style.font.size = Pt(20)
-            title_style.font.bold = True
-            title_style.font.color.rgb = RGBColor(79, 70, 229)  # Color #4f46e5
-            title_style.paragraph_format.alignment = WD_ALIGN_PARAGRAPH.CENTER
-            title_style.paragraph_format.space_after = Pt(12)
-
-        # Estilo para Encabezado 1
-        if 'CustomHeading1' not in styles:
-            h1_style = styles.add_style('CustomHeading1', 1)
-            h1_style.base_style = styles['Heading 1']
-            h1_style.font.name = 'Calibri'
-            h1_style.font.size = Pt(16)
-            h1_style.font.bold = True
-            h1_style.font.color.rgb = RGBColor(79, 70, 229)
-            h1_style.paragraph_format.space_before = Pt(18)
-            h1_style.paragraph_format.space_after = Pt(8)
-
-        # Estilo para Encabezado 2
-        if 'CustomHeading2' not in styles:
-            h2_style = styles.add_style('CustomHeading2', 1)
-            h2_style.base_style = styles['Heading 2']
-            h2_style.font.name = 'Calibri'
-            h2_style.font.size = Pt(14)
-            h2_style.font.bold = True
-            h2_style.font.color.rgb = RGBColor(79, 70, 229)
-            h2_style.paragraph_format.space_before = Pt(14)
-            h2_style.paragraph_format.space_after = Pt(6)
-
-        # Estilo para Párrafos
-        if 'CustomNormal' not in styles:
-            normal_style = styles.add_style('CustomNormal', 1)
-            normal_style.font.name = 'Calibri'
-            normal_style.font.size = Pt(11)
-            normal_style.paragraph_format.space_after = Pt(10)
-            normal_style.paragraph_format.line_spacing = 1.15
-            normal_style.paragraph_format.alignment = WD_ALIGN_PARAGRAPH.JUSTIFY  # Justificar el texto
-
-        # Añadir encabezado y pie de página
-        section = doc.sections[0]
-        header = section.header
-        header_text = translate_text("Documento Generado Automáticamente - IA Generador", language)
-        header.paragraphs[0].text = header_text
-        header.paragraphs[0].style.font.size = Pt(8)
-        footer = section.footer
-        footer_text = translate_text("Página {PAGE}", language)
-        footer.paragraphs[0].text = footer_text
-        footer.paragraphs[0].style.font.size = Pt(8)
-
-        # Añadir logotipo
-        add_logo_to_docx(doc, logo_path)
-
-        # Añadir tabla de contenidos interactiva
-        add_toc_to_docx(doc, language)
-
-        # Procesar contenido
-        lines = text.split('\n')
-        in_list = False
-        list_level = 0
-        table_data = []
-        chart_data = None
-        chart_type = None
-
-        # Detectar gráficos
-        for line in lines:
-            line = line.strip()
-            if "gráfico de barras con datos:" in line.lower():
-                chart_type = "bar"
-                data_str = line.split("con datos:")[1].strip()
-                data_pairs = data_str.split(",")
-                try:
-                    chart_data = {pair.split(":")[0].strip(): float(pair.split(":")[1].strip()) for pair in data_pairs}
-                except Exception as e:
-                    logging.error(f"Error al procesar datos de gráfico en DOCX: {str(e)}")
-                    chart_data = None
-                continue
-            elif "gráfico de líneas con datos:" in line.lower():
-                chart_type = "line"
-                data_str = line.split("con datos:")[1].strip()
-                data_pairs = data_str.split(",")
-                try:
-                    chart_data = {pair.split(":")[0].strip(): float(pair.split(":")[1].strip()) for pair in data_pairs}
-                except Exception as e:
-                    logging.error(f"Error al procesar datos de gráfico en DOCX: {str(e)}")
-                    chart_data = None
-                continue
-
-        # Parsear el contenido
-        for line in lines:
-            line = line.strip()
-            if not line:
-                doc.add_paragraph('')
-                continue
-            if line.startswith('# '):
-                doc.add_paragraph(line[2:], style='CustomHeading1')
-                in_list = False
-            elif line.startswith('## '):
-                doc.add_paragraph(line[3:], style='CustomHeading2')
-                in_list = False
-            elif line.startswith('### '):
-                doc.add_paragraph(line[4:], style='Heading 3')
-                in_list = False
-            elif line.startswith('- ') or line.startswith('* '):
-                style = 'List Bullet' if list_level == 0 else 'List Bullet 2'
-                doc.add_paragraph(line[2:], style=style)
-                in_list = True
-                list_level = 0
-            elif line.startswith('  - ') or line.startswith('  * '):
-                list_level = 1
-                doc.add_paragraph(line[4:], style='List Bullet 2')
-                in_list = True
-            elif line.startswith('|'):
-                cells = [cell.strip() for cell in line.split('|')[1:-1]]
-                if cells and all(cells):
-                    table_data.append(cells)
-            else:
-                if table_data:
-                    try:
-                        table = doc.add_table(rows=len(table_data), cols=len(table_data[0]))
-                        table.style = 'Table Grid'
-                        for i, row in enumerate(table_data):
-                            for j, cell in enumerate(row):
-                                table.cell(i, j).text = cell
-                                table.cell(i, j).paragraphs[0].style = 'CustomNormal'
-                                if i == 0:  # Estilo para el encabezado
-                                    cell_run = table.cell(i, j).paragraphs[0].runs[0]
-                                    cell_run.font.bold = True
-                                    cell_run.font.size = Pt(11)
-                                    cell_run.font.name = 'Calibri'
-                                    shading_elm = OxmlElement('w:shd')
-                                    shading_elm.set(qn('w:fill'), "f0f0f0")
-                                    table.cell(i, j)._element.get_or_add_tcPr().append(shading_elm)
-                        table_data = []
-                        doc.add_paragraph('')
-                    except Exception as e:
-                        logging.error(f"Error al añadir tabla al DOCX: {str(e)}")
-                        table_data = []
-                if in_list:
-                    in_list = False
-                    list_level = 0
-                    doc.add_paragraph('')
-                paragraph = doc.add_paragraph()
-                paragraph.style = 'CustomNormal'
-                parts = re.split(r'(\*\*.*?\*\*|\*.*?\*)', line)
-                for part in parts:
-                    if part.startswith('**') and part.endswith('**'):
-                        run = paragraph.add_run(part[2:-2])
-                        run.bold = True
-                    elif part.startswith('*') and part.endswith('*'):
-                        run = paragraph.add_run(part[1:-1])
-                        run.italic = True
-                    else:
-                        paragraph.add_run(part)
-
-        # Añadir gráfico si existe
-        if chart_data:
-            try:
-                chart_buffer = generate_chart(chart_data, chart_type)
-                if chart_buffer.getvalue():
-                    doc.add_picture(chart_buffer, width=Inches(5))
-                    doc.paragraphs[-1].alignment = WD_ALIGN_PARAGRAPH.CENTER
-                    doc.add_paragraph('')
-                else:
-                    logging.warning("Buffer de gráfico vacío, no se añadió al DOCX")
-            except Exception as e:
-                logging.error(f"Error al añadir gráfico al DOCX: {str(e)}")
-
-    except Exception as e:
-        logging.error(f"Error al generar DOCX en parse_markdown_for_docx: {str(e)}")
-        raise Exception(f"No se pudo generar el documento DOCX: {str(e)}")
\ No newline at end of file
+    toc_flowables.append(Spacer(1, 20))
+    return toc_flowables + story
@@ -0,0 +1,13 @@
+# wsgi.py
+# Punto de entrada para gunicorn con un único worker de hilos:
+#   gunicorn -k gthread -w 1 --threads 32 wsgi:app
+# Un solo proceso porque el estado vive en su memoria: file_storage y los renderizados
+# pendientes, conversation_context, los límites del RateLimiter y la caché L1. Con varios
+# workers, /download podría caer en otro proceso (404) y el límite efectivo de OpenAI se
+# multiplicaría. Solo la caché de respuestas se comparte (Redis); hasta mover el resto a
+# un almacén común no se deben añadir workers.
+# No se usa gevent: su worker ejecuta monkey.patch_all() completo antes de cargar la
+# aplicación, y el bucle asyncio de DocumentGenerator necesita hilos y select reales.
+# Las esperas a OpenAI ya ocurren en ese bucle, así que los hilos del worker no se bloquean
+# por la red más allá de lo que tarda cada petición.
+from ia import app  # noqa: F401